@@ -1,10 +1,10 @@
 """
 PyTorch dataset specifications.
-"""
 
-from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data.dataloader import default_collate
+torch is only imported by the dataset and loader functions, so the numpy
+modules of this package (graph, graph_archive, hit_index,
+graph_construction, build_graphs) can be used without it.
+"""
 
 def get_datasets(name, **data_args):
     if name == 'dummy':
@@ -17,22 +17,64 @@ def get_datasets(name, **data_args):
         raise Exception('Dataset %s unknown' % name)
 
 def get_data_loaders(name, batch_size, distributed=False,
-                     n_workers=0, **data_args):
-    """This may replace the datasets function above"""
+                     n_workers=0, collate='dense', batch_sampler=None,
+                     max_tokens=None, **data_args):
+    """This may replace the datasets function above
+
+    For hitgraphs, collate selects the batching: 'dense' pads Ri/Ro to the
+    largest graph in the batch, 'sparse' builds one block-diagonal graph.
+    batch_sampler='bucket' batches graphs of similar size together, with
+    max_tokens packing batches under a budget on the padded Ri/Ro size
+    n_graphs * max_nodes * max_edges instead of using a fixed batch_size
+    (see hitgraphs.SizeBucketBatchSampler).
+    With cache_bytes in data_args, the workers are kept alive between epochs
+    so that their graph caches are reused. Every worker process has its own
+    cache, so cache_bytes is split evenly over the train and validation
+    workers to bound the total memory. Since shuffled or bucketed batches
+    send a graph to a different worker in each epoch, a worker only hits on
+    the graphs it has seen itself and the hit rate stays below 100% even
+    when the whole dataset would fit into cache_bytes.
+    """
+    from torch.utils.data import DataLoader
+    from torch.utils.data.distributed import DistributedSampler
+    from torch.utils.data.dataloader import default_collate
     collate_fn = default_collate
     if name == 'dummy':
         from .dummy import get_datasets
         train_dataset, valid_dataset = get_datasets(**data_args)
     elif name == 'hitgraphs':
         from . import hitgraphs
-        train_dataset, valid_dataset = hitgraphs.get_datasets(**data_args)
-        collate_fn = hitgraphs.collate_fn
+        if n_workers > 0 and data_args.get('cache_bytes'):
+            n_loaders = 2 if data_args.get('n_valid') else 1
+            data_args = dict(data_args, cache_bytes=max(
+                data_args['cache_bytes'] // (n_workers * n_loaders), 1))
+        collate_fn, graph_type = hitgraphs.get_collate_fn(collate)
+        train_dataset, valid_dataset = hitgraphs.get_datasets(
+            graph_type=graph_type, **data_args)
     else:
         raise Exception('Dataset %s unknown' % name)
 
     # Construct the data loaders
-    loader_args = dict(batch_size=batch_size, collate_fn=collate_fn,
-                       num_workers=n_workers)
+    worker_args = dict(collate_fn=collate_fn, num_workers=n_workers)
+    if n_workers > 0 and data_args.get('cache_bytes'):
+        worker_args['persistent_workers'] = True
+    if batch_sampler is not None:
+        if name != 'hitgraphs' or batch_sampler != 'bucket':
+            raise Exception('Batch sampler %s unknown for %s' % (batch_sampler, name))
+        sampler_args = dict(max_tokens=max_tokens)
+        train_sampler = hitgraphs.SizeBucketBatchSampler.from_dataset(
+            train_dataset, batch_size, distributed=distributed, **sampler_args)
+        train_data_loader = DataLoader(train_dataset, batch_sampler=train_sampler,
+                                       **worker_args)
+        valid_data_loader = None
+        if valid_dataset is not None:
+            valid_sampler = hitgraphs.SizeBucketBatchSampler.from_dataset(
+                valid_dataset, batch_size, shuffle=False, **sampler_args)
+            valid_data_loader = DataLoader(valid_dataset, batch_sampler=valid_sampler,
+                                           **worker_args)
+        return train_data_loader, valid_data_loader
+
+    loader_args = dict(batch_size=batch_size, **worker_args)
     train_sampler = DistributedSampler(train_dataset) if distributed else None
     train_data_loader = DataLoader(train_dataset, sampler=train_sampler, **loader_args)
     valid_data_loader = (DataLoader(valid_dataset, **loader_args)
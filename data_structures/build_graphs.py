@@ -0,0 +1,172 @@
+"""
+Build the hit graphs of a dataset for a list of pt cuts in one pass.
+
+Each event is read once, with only the pixel layers and the particles above
+the loosest pt cut. Its graph is constructed once at the loosest pt cut in a
+worker of a process pool, and the tighter pt cuts are extracted from it. The
+graphs of pt cut 0.5 are written to <output>_0p5/<event>_g000.npz and so on,
+the layout expected by measurements/graph_efficiency.py. Graph files are written atomically and
+events whose graphs all exist are skipped, so an interrupted run can be
+restarted with the same arguments.
+
+    python -m data_structures.build_graphs <dataset> <output> --strategy LP \\
+        --pt-cuts 0.5 0.6 0.75 1 1.5 2 2.5 3 4 5 --n-workers 8
+"""
+
+# System imports
+from __future__ import print_function
+import os
+import re
+import time
+import argparse
+import multiprocessing
+
+# External imports
+from trackml.dataset import load_event, ZipEventStore
+
+# Local imports
+from .graph import SparseGraph, save_graph
+from .graph_construction import (PIXEL_LAYERS, construct_nested_graph,
+                                 extract_graph)
+
+PARTS = ['hits', 'truth', 'particles']
+COLUMNS = dict(hits=['hit_id', 'x', 'y', 'z', 'volume_id', 'layer_id'],
+               truth=['hit_id', 'particle_id'],
+               particles=['particle_id', 'px', 'py'])
+
+def pt_label(pt_cut):
+    """Directory label of a pt cut, e.g. 0p5 for 0.5 and 1 for 1.0"""
+    return ('%g' % pt_cut).replace('.', 'p')
+
+def output_dirs(output, pt_cuts):
+    return [output + '_' + pt_label(pt) for pt in pt_cuts]
+
+def list_events(path):
+    """Sorted event prefixes of a dataset directory or zip file"""
+    if os.path.isdir(path):
+        regex = re.compile(r'(event\d{9})-hits\.csv(\.gz)?$')
+        return sorted(set(m.group(1) for m in map(regex.match, os.listdir(path))
+                          if m is not None))
+    with ZipEventStore(path) as store:
+        return ['event%09d' % event_id for event_id in store.event_ids]
+
+def _graph_file(output_dir, prefix):
+    return os.path.join(output_dir, prefix + '_g000.npz')
+
+def _event_done(prefix, dirs):
+    return all(os.path.exists(_graph_file(d, prefix)) for d in dirs)
+
+# Zip dataset of this process, opened once and indexed once
+_store = None
+
+def _open_store(path):
+    """Open the zip dataset for the loads of this process (pool initializer)"""
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = ZipEventStore(path) if not os.path.isdir(path) else None
+
+def _close_store():
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
+
+def _load(path, prefix, pt_min):
+    select = dict(columns=COLUMNS, layers=PIXEL_LAYERS, pt_min=pt_min)
+    if os.path.isdir(path):
+        return load_event(os.path.join(path, prefix), parts=PARTS, **select)
+    if _store is None or _store.path != path:
+        _open_store(path)
+    return _store.load_event(int(prefix[5:]), parts=PARTS, **select)
+
+def build_event(path, prefix, dirs, pt_cuts, strategy='LP', **cuts):
+    """Build and write all pt cut graphs of one event"""
+    pt_min = min(pt_cuts)
+    hits, truth, particles = _load(path, prefix, pt_min)
+    nested = construct_nested_graph(hits, truth, particles, pt_min=pt_min,
+                                    strategy=strategy, **cuts)
+    for output_dir, pt_cut in zip(dirs, pt_cuts):
+        graph = extract_graph(nested, pt_cut, graph_type=SparseGraph)
+        filename = _graph_file(output_dir, prefix)
+        tmp_file = filename + '.tmp-%i' % os.getpid()
+        with open(tmp_file, 'wb') as f:
+            save_graph(graph, f)
+        os.rename(tmp_file, filename)
+    return prefix
+
+def _build_event_task(args):
+    path, prefix, dirs, pt_cuts, options = args
+    return build_event(path, prefix, dirs, pt_cuts, **options)
+
+def build_graphs(path, output, pt_cuts, strategy='LP', n_workers=1,
+                 skip=None, n_events=None, **cuts):
+    """Build the graphs of all events of a dataset for the given pt cuts
+
+    Returns the number of events that were built, events that are complete
+    from an earlier run are skipped.
+    """
+    pt_cuts = sorted(pt_cuts)
+    dirs = output_dirs(output, pt_cuts)
+    for d in dirs:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    prefixes = list_events(path)[skip:]
+    if n_events is not None:
+        prefixes = prefixes[:n_events]
+    todo = [p for p in prefixes if not _event_done(p, dirs)]
+    print('Building %i of %i events for pt cuts %s' %
+          (len(todo), len(prefixes), ' '.join(map(pt_label, pt_cuts))))
+
+    options = dict(cuts, strategy=strategy)
+    tasks = [(path, p, dirs, pt_cuts, options) for p in todo]
+    start = time.time()
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers, initializer=_open_store,
+                                    initargs=(path,))
+        try:
+            results = pool.imap_unordered(_build_event_task, tasks)
+            for i, prefix in enumerate(results):
+                print('  %s done (%i/%i)' % (prefix, i + 1, len(tasks)))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        try:
+            for i, task in enumerate(tasks):
+                print('  %s done (%i/%i)' % (_build_event_task(task), i + 1, len(tasks)))
+        finally:
+            _close_store()
+    print('Built %i events in %.1f s' % (len(tasks), time.time() - start))
+    return len(tasks)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the hit graphs of a dataset for several pt cuts')
+    add_arg = parser.add_argument
+    add_arg('input', help='Dataset directory or zip file')
+    add_arg('output', help='Output prefix, graphs go to <output>_<pt>/')
+    add_arg('--strategy', choices=['LP', 'LPP'], default='LP')
+    add_arg('--pt-cuts', type=float, nargs='+',
+            default=[0.5, 0.6, 0.75, 1, 1.5, 2, 2.5, 3, 4, 5])
+    add_arg('--n-workers', type=int, default=1)
+    add_arg('--skip', type=int, default=None)
+    add_arg('--n-events', type=int, default=None)
+    add_arg('--max-layer-gap', type=int, default=None,
+            help='Default: all layer pairs for LP, adjacent layers for LPP')
+    for cut in ['phi-slope-max', 'z0-max', 'dphi-max', 'dz-max',
+                'intra-dphi-max', 'intra-dz-max']:
+        add_arg('--' + cut, type=float, default=None)
+    args = parser.parse_args()
+
+    cuts = dict(max_layer_gap=args.max_layer_gap)
+    for cut in ['phi_slope_max', 'z0_max', 'dphi_max', 'dz_max',
+                'intra_dphi_max', 'intra_dz_max']:
+        if getattr(args, cut) is not None:
+            cuts[cut] = getattr(args, cut)
+    build_graphs(args.input, args.output, args.pt_cuts, strategy=args.strategy,
+                 n_workers=args.n_workers, skip=args.skip,
+                 n_events=args.n_events, **cuts)
+
+if __name__ == '__main__':
+    main()
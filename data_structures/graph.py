@@ -1,8 +1,10 @@
 """
 This module contains code for interacting with hit graphs.
 A Graph is a namedtuple of matrices X, Ri, Ro, y.
+A SparseGraph is a namedtuple of X, y and the edge index arrays Ri_index, Ro_index.
 """
 
+import zipfile
 from collections import namedtuple
 
 import numpy as np
@@ -10,7 +12,17 @@ import numpy as np
 # A Graph is a namedtuple of matrices (X, Ri, Ro, y)
 Graph = namedtuple('Graph', ['X', 'Ri', 'Ro', 'y'])
 
+# A SparseGraph stores the edges as index arrays of length n_edges instead of
+# dense n_nodes x n_edges matrices: Ri_index[s] is the node that segment s is
+# incoming to (target), Ro_index[s] is the node it is outgoing from (source).
+SparseGraph = namedtuple('SparseGraph', ['X', 'Ri_index', 'Ro_index', 'y'])
+
 def graph_to_sparse(graph):
+    if isinstance(graph, SparseGraph):
+        edges = np.arange(graph.y.shape[0], dtype=np.int32)
+        return dict(X=graph.X, y=graph.y,
+                    Ri_rows=graph.Ri_index, Ri_cols=edges,
+                    Ro_rows=graph.Ro_index, Ro_cols=edges)
     Ri_rows, Ri_cols = graph.Ri.nonzero()
     Ro_rows, Ro_cols = graph.Ro.nonzero()
     return dict(X=graph.X, y=graph.y,
@@ -25,6 +37,25 @@ def sparse_to_graph(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y, dtype=np.uint8):
     Ro[Ro_rows, Ro_cols] = 1
     return Graph(X, Ri, Ro, y)
 
+def sparse_to_sparse_graph(X, Ri_rows, Ri_cols, Ro_rows, Ro_cols, y):
+    """Build a SparseGraph from the stored (row, column) pairs"""
+    n_edges = y.shape[0]
+    Ri_index = np.empty(n_edges, dtype=np.int32)
+    Ro_index = np.empty(n_edges, dtype=np.int32)
+    Ri_index[Ri_cols] = Ri_rows
+    Ro_index[Ro_cols] = Ro_rows
+    return SparseGraph(X, Ri_index, Ro_index, y)
+
+def sparse_graph_to_graph(graph, dtype=np.uint8):
+    """Convert a SparseGraph to the dense Graph representation"""
+    edges = np.arange(graph.y.shape[0])
+    return sparse_to_graph(graph.X, graph.Ri_index, edges,
+                           graph.Ro_index, edges, graph.y, dtype=dtype)
+
+def graph_to_sparse_graph(graph):
+    """Convert a dense Graph to the SparseGraph representation"""
+    return sparse_to_sparse_graph(**graph_to_sparse(graph))
+
 def save_graph(graph, filename):
     """Write a single graph to an NPZ file archive"""
     np.savez(filename, **graph_to_sparse(graph))
@@ -33,10 +64,35 @@ def save_graphs(graphs, filenames):
     for graph, filename in zip(graphs, filenames):
         save_graph(graph, filename)
 
-def load_graph(filename):
-    """Reade a single graph NPZ"""
+def load_graph(filename, graph_type=Graph):
+    """Reade a single graph NPZ
+
+    With graph_type=SparseGraph the edge index arrays are returned directly
+    and the dense Ri/Ro matrices are never built.
+    """
     with np.load(filename) as f:
+        if graph_type is SparseGraph:
+            return sparse_to_sparse_graph(**dict(f.items()))
         return sparse_to_graph(**dict(f.items()))
 
+def load_graph_shapes(filename):
+    """Read the array shapes of a graph NPZ from the npy headers only"""
+    shapes = {}
+    with zipfile.ZipFile(filename) as z:
+        for member in z.namelist():
+            with z.open(member) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                else:
+                    header = np.lib.format.read_array_header_2_0(f)
+            shapes[member[:-4] if member.endswith('.npy') else member] = header[0]
+    return shapes
+
+def graph_size(filename):
+    """Number of nodes and edges of a graph NPZ without loading it"""
+    shapes = load_graph_shapes(filename)
+    return shapes['X'][0], shapes['y'][0]
+
 def load_graphs(filenames, graph_type=Graph):
     return [load_graph(f, graph_type) for f in filenames]
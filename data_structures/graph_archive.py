@@ -0,0 +1,199 @@
+"""
+Single-file archive of many hit graphs.
+
+All graphs are stored as contiguous arrays (X, Ri_index, Ro_index, y) that are
+concatenated over graphs, plus node and edge offsets per graph. The file is
+memory-mapped on reading, so a graph is a zero-copy slice of the arrays.
+
+Layout: 8 byte magic, 8 byte little-endian header length, JSON header with
+the names, dtypes, shapes and offsets of the arrays, then the array data.
+Each array starts at a 64 byte aligned offset.
+
+The converter from a directory of per-event npz files can be run as
+
+    python -m data_structures.graph_archive <input_dir> <output_file>
+"""
+
+# System imports
+from __future__ import print_function
+import os
+import json
+import shutil
+import struct
+import argparse
+import tempfile
+
+# External imports
+import numpy as np
+
+# Local imports
+from .graph import (Graph, SparseGraph, load_graph, graph_to_sparse_graph,
+                    sparse_graph_to_graph)
+
+MAGIC = b'HGRAPHS1'
+ALIGNMENT = 64
+EDGE_ARRAYS = ['Ri_index', 'Ro_index', 'y']
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def save_graph_archive(graphs, filename, names=None):
+    """Write graphs (Graph or SparseGraph) into a single archive file.
+
+    The graphs are streamed to temporary per-array files first, so only one
+    graph is held in memory at a time.
+    """
+    names = [] if names is None else list(names)
+    out_dir = os.path.dirname(os.path.abspath(filename))
+    tmp_dir = tempfile.mkdtemp(dir=out_dir, prefix='.tmp-')
+    try:
+        parts = {k: open(os.path.join(tmp_dir, k), 'wb')
+                 for k in ['X'] + EDGE_ARRAYS}
+        node_offsets, edge_offsets = [0], [0]
+        dtypes, n_features = {}, None
+        for i, graph in enumerate(graphs):
+            if not isinstance(graph, SparseGraph):
+                graph = graph_to_sparse_graph(graph)
+            graph = graph._replace(Ri_index=graph.Ri_index.astype(np.int32),
+                                   Ro_index=graph.Ro_index.astype(np.int32))
+            if n_features is None:
+                n_features = graph.X.shape[1]
+                dtypes = {k: getattr(graph, k).dtype.str for k in parts}
+            if graph.X.shape[1] != n_features:
+                raise Exception('Graph %i has %i features, expected %i' %
+                                (i, graph.X.shape[1], n_features))
+            for k in parts:
+                a = np.ascontiguousarray(getattr(graph, k), dtype=dtypes[k])
+                parts[k].write(a.tobytes())
+            node_offsets.append(node_offsets[-1] + graph.X.shape[0])
+            edge_offsets.append(edge_offsets[-1] + graph.y.shape[0])
+        for f in parts.values():
+            f.close()
+        n_graphs = len(node_offsets) - 1
+        if names and len(names) != n_graphs:
+            raise Exception('Got %i names for %i graphs' % (len(names), n_graphs))
+        if n_features is None:
+            n_features = 0
+            dtypes = dict(X='<f4', Ri_index='<i4', Ro_index='<i4', y='<f4')
+
+        # Offsets are stored as arrays in the data section, too
+        offsets = dict(node_offsets=np.array(node_offsets, dtype='<i8'),
+                       edge_offsets=np.array(edge_offsets, dtype='<i8'))
+        for k, a in offsets.items():
+            with open(os.path.join(tmp_dir, k), 'wb') as f:
+                f.write(a.tobytes())
+            dtypes[k] = a.dtype.str
+        shapes = dict(X=[node_offsets[-1], n_features],
+                      node_offsets=[n_graphs + 1], edge_offsets=[n_graphs + 1])
+        shapes.update({k: [edge_offsets[-1]] for k in EDGE_ARRAYS})
+
+        # Data offsets are relative to the aligned end of the header
+        arrays, offset = {}, 0
+        for k in sorted(shapes):
+            arrays[k] = dict(dtype=dtypes[k], shape=shapes[k], offset=offset)
+            size = os.path.getsize(os.path.join(tmp_dir, k))
+            offset = _aligned(offset + size)
+        header = json.dumps(dict(arrays=arrays, names=names)).encode('utf-8')
+
+        tmp_file = os.path.join(tmp_dir, 'archive')
+        with open(tmp_file, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<Q', len(header)))
+            out.write(header)
+            data_start = _aligned(out.tell())
+            for k in sorted(arrays):
+                out.seek(data_start + arrays[k]['offset'])
+                with open(os.path.join(tmp_dir, k), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        os.rename(tmp_file, filename)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class GraphArchive(object):
+    """Memory-mapped reader for a single-file graph archive"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._open()
+
+    def _open(self):
+        with open(self.filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception('%s is not a graph archive' % self.filename)
+            header_size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_size).decode('utf-8'))
+            data_start = _aligned(f.tell())
+        self.names = header['names']
+        self._arrays = {}
+        for k, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if np.prod(shape) == 0:
+                # zero-sized arrays can not be memory-mapped
+                self._arrays[k] = np.zeros(shape, dtype=spec['dtype'])
+            else:
+                self._arrays[k] = np.memmap(
+                    self.filename, dtype=spec['dtype'], mode='r',
+                    offset=data_start + spec['offset'], shape=shape)
+        self.node_offsets = self._arrays['node_offsets']
+        self.edge_offsets = self._arrays['edge_offsets']
+
+    def __getstate__(self):
+        # Re-map the file instead of copying the data, e.g. into DataLoader workers
+        return dict(filename=self.filename)
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._open()
+
+    def __len__(self):
+        return self.node_offsets.shape[0] - 1
+
+    def n_nodes(self):
+        """Number of nodes of all graphs without reading the graphs"""
+        return np.diff(self.node_offsets)
+
+    def n_edges(self):
+        """Number of edges of all graphs without reading the graphs"""
+        return np.diff(self.edge_offsets)
+
+    def __getitem__(self, index):
+        """Zero-copy SparseGraph view of one graph"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('graph index %i out of range' % index)
+        n0, n1 = self.node_offsets[index], self.node_offsets[index + 1]
+        e0, e1 = self.edge_offsets[index], self.edge_offsets[index + 1]
+        a = self._arrays
+        return SparseGraph(a['X'][n0:n1], a['Ri_index'][e0:e1],
+                           a['Ro_index'][e0:e1], a['y'][e0:e1])
+
+    def load_graph(self, index, graph_type=Graph):
+        """Read one graph as Graph or SparseGraph"""
+        graph = self[index]
+        if graph_type is SparseGraph:
+            return graph
+        # dense graphs are handed to torch as is, so detach them from the
+        # read-only memory map
+        return sparse_graph_to_graph(graph._replace(X=np.array(graph.X),
+                                                    y=np.array(graph.y)))
+
+def convert_graph_dir(input_dir, filename):
+    """Convert a directory of per-event graph npz files into one archive"""
+    files = sorted(f for f in os.listdir(input_dir)
+                   if f.startswith('event') and f.endswith('.npz'))
+    graphs = (load_graph(os.path.join(input_dir, f), SparseGraph) for f in files)
+    save_graph_archive(graphs, filename, names=files)
+    return len(files)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a directory of graph npz files into a graph archive')
+    parser.add_argument('input_dir', help='Directory with event*.npz graphs')
+    parser.add_argument('output', help='Archive file to write')
+    args = parser.parse_args()
+    n_graphs = convert_graph_dir(args.input_dir, args.output)
+    print('Wrote', n_graphs, 'graphs to', args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Vectorized construction of hit graphs from TrackML events.
+
+The hits of an event (as returned by trackml.dataset.load_event) in the
+selected pixel_layers are connected by segments between pairs of layers.
+Candidate pairs are looked up in a phi/z grid index of the hits (see
+hit_index.py) within the window allowed by the cuts, and then filtered with
+the dphi/dz/phi_slope/z0 cuts, without Python loops over hits.
+
+Two strategies are supported:
+
+* layer pairs (LP): only the innermost hit of each particle in each layer is
+  kept and segments connect hits in different layers.
+* layer pairs plus (LPP): all hits are kept and, in addition, hits inside
+  the same layer are connected in both directions, selected with the
+  intra_dphi_max/intra_dz_max cuts.
+
+A segment between layers is true (y=1) if both hits belong to the same
+particle and the particle has no hit in the layers in between. A segment
+inside a layer is true if it joins consecutive hits (in r) of the same
+particle. LP connects all layer pairs and LPP adjacent layers by default
+(max_layer_gap), so that with all cuts open the number of true segments is
+the LP or LPP truth count of measurements/truth/generate_truth.py.
+"""
+
+# System imports
+from collections import namedtuple
+
+# External imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from .graph import Graph, SparseGraph, sparse_graph_to_graph
+from .hit_index import HitIndex
+
+# Pixel barrel layers as (volume_id, layer_id)
+PIXEL_LAYERS = [(8,2), (8,4), (8,6), (8,8)]
+
+# A NestedGraph is a SparseGraph with the pt of the particle of each node and
+# the smaller pt of the two nodes of each edge. A graph at a pt cut is the
+# subgraph of the graph at any looser pt cut.
+NestedGraph = namedtuple('NestedGraph', SparseGraph._fields + ('node_pt', 'edge_pt'))
+
+FEATURE_NAMES = ['r', 'phi', 'z']
+FEATURE_SCALE = np.array([1000., np.pi, 1000.])
+
+def calc_dphi(phi1, phi2):
+    """Difference phi2 - phi1 wrapped into [-pi, pi)"""
+    return (phi2 - phi1 + np.pi) % (2 * np.pi) - np.pi
+
+def get_layer_pairs(n_layers, max_gap=1):
+    """Ordered (inner, outer) layer index pairs at most max_gap layers apart"""
+    return [(i, j) for i in range(n_layers)
+            for j in range(i + 1, min(i + max_gap, n_layers - 1) + 1)]
+
+def select_hits(hits, truth, particles, pixel_layers=PIXEL_LAYERS,
+                pt_min=None, one_per_layer=True):
+    """Select the hits of particles with pt > pt_min in pixel_layers
+
+    Noise hits are dropped. The layer index into pixel_layers, the
+    cylindrical coordinates r, phi and the particle pt are added. With one_per_layer only the hit
+    with the smallest r of each particle in each layer is kept.
+    """
+    layers = pd.DataFrame(pixel_layers, columns=['volume_id', 'layer_id'])
+    layers['layer'] = np.arange(len(pixel_layers))
+    particles = particles[['particle_id']].assign(
+        pt=np.sqrt(particles.px**2 + particles.py**2))
+    if pt_min is not None:
+        particles = particles[particles.pt > pt_min]
+    hits = (hits[['hit_id', 'x', 'y', 'z', 'volume_id', 'layer_id']]
+            .merge(layers, on=['volume_id', 'layer_id'])
+            .merge(truth[['hit_id', 'particle_id']], on='hit_id')
+            .merge(particles, on='particle_id'))
+    hits = hits.assign(r=np.sqrt(hits.x**2 + hits.y**2),
+                       phi=np.arctan2(hits.y, hits.x))
+    if one_per_layer:
+        # Stable sort, so ties in r keep the first hit like groupby().idxmin()
+        order = np.lexsort((hits.r.values, hits.layer.values,
+                            hits.particle_id.values))
+        keys = hits[['particle_id', 'layer']].values[order]
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+        hits = hits.iloc[np.sort(order[first])]
+    return hits.reset_index(drop=True)
+
+def _z_window(r1, z1, r2_min, r2_max, z0_max=None, dz_max=None):
+    """Range of z2 allowed by the dz and z0 cuts for hits in (r2_min, r2_max)"""
+    z_lo = np.full(z1.shape, -np.inf)
+    z_hi = np.full(z1.shape, np.inf)
+    if dz_max is not None:
+        z_lo, z_hi = z1 - dz_max, z1 + dz_max
+    if z0_max is not None:
+        # dz = dr * (z1 - z0) / r1, extremal at the corners of dr and z0
+        dr_min, dr_max = r2_min - r1, r2_max - r1
+        valid = (dr_min > 0) & (r1 > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corners = np.stack([dr * (z1 + z0) / r1 for dr in (dr_min, dr_max)
+                                for z0 in (-z0_max, z0_max)])
+        z_lo = np.where(valid, np.maximum(z_lo, z1 + corners.min(axis=0)), z_lo)
+        z_hi = np.where(valid, np.minimum(z_hi, z1 + corners.max(axis=0)), z_hi)
+    return z_lo, z_hi
+
+def select_segments(hits1, hits2, phi_slope_max=None, z0_max=None,
+                    dphi_max=None, dz_max=None, index=None, key=()):
+    """Find the segments from hits1 to hits2 passing the cuts
+
+    Cuts that are None are not applied. The candidates are looked up in
+    the hits of index (a HitIndex of hits2) with the given key; by default
+    an index of all of hits2 is built. Returns the positional indices into
+    hits1 and hits2 of the selected segments.
+    """
+    if index is None:
+        index = HitIndex(hits2, keys=())
+    r1, phi1, z1 = [hits1[k].values for k in ['r', 'phi', 'z']]
+    r2, phi2, z2 = [hits2[k].values for k in ['r', 'phi', 'z']]
+    layer_r2 = r2[index.layer_hits(key)]
+    if r1.shape[0] == 0 or layer_r2.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Bound the candidate search window by the cuts
+    window = np.pi
+    if dphi_max is not None:
+        window = min(window, dphi_max)
+    if phi_slope_max is not None:
+        window = min(window, phi_slope_max * np.abs(layer_r2.max() - r1.min()))
+    z_lo, z_hi = _z_window(r1, z1, layer_r2.min(), layer_r2.max(),
+                           z0_max, dz_max)
+    i, j = index.query(key, phi1, window, z_lo, z_hi)
+
+    dphi = calc_dphi(phi1[i], phi2[j])
+    dz = z2[j] - z1[i]
+    dr = r2[j] - r1[i]
+    mask = np.ones(i.shape[0], dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if dphi_max is not None:
+            mask &= np.abs(dphi) < dphi_max
+        if dz_max is not None:
+            mask &= np.abs(dz) < dz_max
+        if phi_slope_max is not None:
+            mask &= np.abs(dphi / dr) < phi_slope_max
+        if z0_max is not None:
+            mask &= np.abs(z1[i] - r1[i] * dz / dr) < z0_max
+    return i[mask], j[mask]
+
+def select_intra_segments(hits, dphi_max=None, dz_max=None, index=None,
+                          key=()):
+    """Find the segments between different hits of one layer passing the cuts
+
+    The layer is given by the key of index (a HitIndex of hits); by default
+    all of hits are one layer. Both directions of each pair are returned as
+    positional indices into hits.
+    """
+    if index is None:
+        index = HitIndex(hits, keys=())
+    phi, z = hits.phi.values, hits.z.values
+    layer_hits = index.layer_hits(key)
+    window = np.pi if dphi_max is None else min(np.pi, dphi_max)
+    if dz_max is None:
+        i, j = index.query(key, phi[layer_hits], window)
+    else:
+        i, j = index.query(key, phi[layer_hits], window,
+                           z[layer_hits] - dz_max, z[layer_hits] + dz_max)
+    i = layer_hits[i]
+    mask = i != j
+    if dphi_max is not None:
+        mask &= np.abs(calc_dphi(phi[i], phi[j])) < dphi_max
+    if dz_max is not None:
+        mask &= np.abs(z[j] - z[i]) < dz_max
+    return i[mask], j[mask]
+
+def segment_truth(hits, seg_out, seg_in):
+    """Truth label of the segments from hits seg_out to hits seg_in"""
+    pid, layer = hits.particle_id.values, hits.layer.values
+    order = np.lexsort((hits.r.values, layer, pid))
+    sorted_pid, sorted_layer = pid[order], layer[order]
+    n_hits = order.shape[0]
+
+    # Next hit in r of the same particle in the same layer
+    same = ((sorted_pid[1:] == sorted_pid[:-1]) &
+            (sorted_layer[1:] == sorted_layer[:-1]))
+    next_in_layer = np.full(n_hits, -1, dtype=np.int64)
+    next_in_layer[order[:-1][same]] = order[1:][same]
+
+    # Next layer with hits of the same particle
+    group_start = np.ones(n_hits, dtype=bool)
+    group_start[1:] = ~same
+    group = np.cumsum(group_start) - 1
+    group_pid, group_layer = sorted_pid[group_start], sorted_layer[group_start]
+    group_next = np.full(group_pid.shape[0], -1, dtype=np.int64)
+    has_next = group_pid[1:] == group_pid[:-1]
+    group_next[:-1][has_next] = group_layer[1:][has_next]
+    next_layer = np.empty(n_hits, dtype=np.int64)
+    next_layer[order] = group_next[group]
+
+    intra = layer[seg_out] == layer[seg_in]
+    y_intra = ((next_in_layer[seg_out] == seg_in) |
+               (next_in_layer[seg_in] == seg_out))
+    y_inter = ((pid[seg_out] == pid[seg_in]) &
+               (next_layer[seg_out] == layer[seg_in]))
+    return np.where(intra, y_intra, y_inter).astype(np.float32)
+
+def construct_graph(hits, layer_pairs, intra_layers=(), graph_type=Graph,
+                    feature_names=FEATURE_NAMES, feature_scale=FEATURE_SCALE,
+                    intra_dphi_max=None, intra_dz_max=None, index_args=None,
+                    **cuts):
+    """Construct one graph from selected hits (see select_hits)
+
+    Segments go from the inner to the outer hit of each layer pair and are
+    selected with the cuts of select_segments. Hits inside each of the
+    intra_layers are connected with select_intra_segments. The candidates
+    are looked up in one HitIndex of the hits by layer, built with
+    index_args. The segments are sorted by (outgoing, incoming) hit, so the
+    graph does not depend on the index binning.
+    """
+    index = HitIndex(hits, keys=['layer'], **(index_args or {}))
+    seg_out, seg_in = [], []
+    for layer1, layer2 in layer_pairs:
+        idx1 = index.layer_hits(layer1)
+        i, j = select_segments(hits.iloc[idx1], hits, index=index,
+                               key=layer2, **cuts)
+        seg_out.append(idx1[i])
+        seg_in.append(j)
+    for layer in intra_layers:
+        i, j = select_intra_segments(hits, intra_dphi_max, intra_dz_max,
+                                     index=index, key=layer)
+        seg_out.append(i)
+        seg_in.append(j)
+    seg_out = np.concatenate(seg_out + [np.zeros(0, dtype=np.int64)])
+    seg_in = np.concatenate(seg_in + [np.zeros(0, dtype=np.int64)])
+    order = np.lexsort((seg_in, seg_out))
+    seg_out, seg_in = seg_out[order], seg_in[order]
+
+    X = (hits[feature_names].values / feature_scale).astype(np.float32)
+    y = segment_truth(hits, seg_out, seg_in)
+    graph = SparseGraph(X, seg_in.astype(np.int32), seg_out.astype(np.int32), y)
+    if graph_type is SparseGraph:
+        return graph
+    return sparse_graph_to_graph(graph)
+
+def construct_nested_graph(hits, truth, particles, pixel_layers=PIXEL_LAYERS,
+                           pt_min=None, strategy='LP', max_layer_gap=None,
+                           **cuts):
+    """Construct the LP or LPP graph of one event with node and edge pt
+
+    The cuts (phi_slope_max, z0_max, dphi_max, dz_max and, for LPP,
+    intra_dphi_max, intra_dz_max) are all open by default. Layers at most
+    max_layer_gap apart are connected, by default all layer pairs for LP and
+    adjacent layers for LPP as in the truth counts. The graph for any
+    tighter pt cut can be taken from the result with extract_graph.
+    """
+    if strategy not in ('LP', 'LPP'):
+        raise Exception('Graph construction strategy %s unknown' % strategy)
+    if max_layer_gap is None:
+        max_layer_gap = len(pixel_layers) if strategy == 'LP' else 1
+    hits = select_hits(hits, truth, particles, pixel_layers, pt_min,
+                       one_per_layer=(strategy == 'LP'))
+    n_layers = len(pixel_layers)
+    layer_pairs = get_layer_pairs(n_layers, max_layer_gap)
+    intra_layers = range(n_layers) if strategy == 'LPP' else ()
+    graph = construct_graph(hits, layer_pairs, intra_layers,
+                            graph_type=SparseGraph, **cuts)
+    node_pt = hits.pt.values
+    edge_pt = np.minimum(node_pt[graph.Ri_index], node_pt[graph.Ro_index])
+    return NestedGraph(*(graph + (node_pt, edge_pt)))
+
+def extract_graph(graph, pt_min=None, graph_type=Graph):
+    """Graph of a NestedGraph for a pt cut at or above the one it was built with
+
+    Keeps the nodes and edges with pt > pt_min and renumbers the nodes.
+    The result is identical to a graph constructed with this pt cut.
+    """
+    sparse = SparseGraph(graph.X, graph.Ri_index, graph.Ro_index, graph.y)
+    if pt_min is not None:
+        node_mask = graph.node_pt > pt_min
+        edge_mask = graph.edge_pt > pt_min
+        new_index = (np.cumsum(node_mask) - 1).astype(np.int32)
+        sparse = SparseGraph(graph.X[node_mask],
+                             new_index[graph.Ri_index[edge_mask]],
+                             new_index[graph.Ro_index[edge_mask]],
+                             graph.y[edge_mask])
+    if graph_type is SparseGraph:
+        return sparse
+    return sparse_graph_to_graph(sparse)
+
+def construct_event_graph(hits, truth, particles, pixel_layers=PIXEL_LAYERS,
+                          pt_min=None, strategy='LP', max_layer_gap=None,
+                          graph_type=Graph, **cuts):
+    """Construct the LP or LPP graph of one event
+
+    The cuts (phi_slope_max, z0_max, dphi_max, dz_max and, for LPP,
+    intra_dphi_max, intra_dz_max) are all open by default, see
+    construct_nested_graph for max_layer_gap.
+    """
+    graph = construct_nested_graph(hits, truth, particles, pixel_layers,
+                                   pt_min, strategy, max_layer_gap, **cuts)
+    return extract_graph(graph, graph_type=graph_type)
@@ -0,0 +1,140 @@
+"""
+Grid index of the hits of one event for fast spatial lookups.
+
+Hits are bucketed by (volume, layer, phi bin, z bin) and stored as sorted
+contiguous arrays with bucket offsets, so all hits of a layer, or of a phi/z
+bin of a layer, are one slice. Phi bins cover [0, 2pi) like the module
+binning of visualization_scripts/segment_detector.py, and range queries wrap
+around in phi. The z bins split the z extent of each layer evenly.
+"""
+
+# External imports
+import numpy as np
+
+class HitIndex(object):
+    """Hits bucketed by (keys, phi bin, z bin)
+
+    hits is a DataFrame with the key columns (by default volume_id and
+    layer_id), z and either phi or x and y. The bucket of each hit is kept
+    in phi_bin and z_bin; positions returned by the queries are row
+    positions into hits.
+    """
+
+    def __init__(self, hits, n_phi_bins=64, n_z_bins=16,
+                 keys=('volume_id', 'layer_id')):
+        self.n_phi_bins = n_phi_bins
+        self.n_z_bins = n_z_bins
+        self.keys = tuple(keys)
+        n_hits = hits.shape[0]
+        if 'phi' in hits:
+            phi = hits.phi.values
+        else:
+            phi = np.arctan2(hits.y.values, hits.x.values)
+        z = hits.z.values.astype(np.float64)
+
+        # Dense layer number of each hit
+        if self.keys:
+            key_values = hits[list(self.keys)].values
+            layers, layer = np.unique(key_values, axis=0, return_inverse=True)
+            layer = layer.reshape(-1)
+            self.layers = [tuple(k) for k in layers.tolist()]
+        else:
+            layer = np.zeros(n_hits, dtype=np.int64)
+            self.layers = [()]
+        self._layer_number = dict((k, i) for i, k in enumerate(self.layers))
+        n_layers = len(self.layers)
+
+        # Even z bins over the z extent of each layer
+        self.z_min = np.full(n_layers, np.inf)
+        z_max = np.full(n_layers, -np.inf)
+        np.minimum.at(self.z_min, layer, z)
+        np.maximum.at(z_max, layer, z)
+        self.z_min[~np.isfinite(self.z_min)] = 0.
+        width = (z_max - self.z_min) / n_z_bins
+        self.z_width = np.where(width > 0, width, 1.)
+
+        self.phi_bin = self._phi_bin(phi)
+        self.z_bin = self._z_bin(layer, z)
+        bucket = (layer * n_phi_bins + self.phi_bin) * n_z_bins + self.z_bin
+        order = np.argsort(bucket, kind='stable')
+        n_buckets = n_layers * n_phi_bins * n_z_bins
+        self.offsets = np.searchsorted(bucket[order], np.arange(n_buckets + 1))
+        self.hit_index = order
+        self.phi = phi[order]
+        self.z = z[order]
+
+    def _phi_bin(self, phi):
+        phi_bin = np.floor(np.mod(phi, 2*np.pi) / (2*np.pi) * self.n_phi_bins)
+        return np.minimum(phi_bin.astype(np.int64), self.n_phi_bins - 1)
+
+    def _z_bin(self, layer, z):
+        z_bin = np.floor((z - self.z_min[layer]) / self.z_width[layer])
+        return np.clip(z_bin, 0, self.n_z_bins - 1).astype(np.int64)
+
+    def layer_number(self, key):
+        """Dense number of a (volume, layer) key, None if it has no hits"""
+        return self._layer_number.get(tuple(key) if np.ndim(key) else (key,))
+
+    def layer_hits(self, key):
+        """Row positions of all hits with the given key"""
+        layer = self.layer_number(key)
+        if layer is None:
+            return np.zeros(0, dtype=np.int64)
+        size = self.n_phi_bins * self.n_z_bins
+        return self.hit_index[self.offsets[layer*size]:self.offsets[(layer+1)*size]]
+
+    def bin_hits(self, key, phi_bin, z_bin=None):
+        """Row positions of the hits in one phi bin (and z bin) of a layer"""
+        layer = self.layer_number(key)
+        if layer is None:
+            return np.zeros(0, dtype=np.int64)
+        base = (layer * self.n_phi_bins + phi_bin) * self.n_z_bins
+        if z_bin is None:
+            return self.hit_index[self.offsets[base]:self.offsets[base + self.n_z_bins]]
+        return self.hit_index[self.offsets[base + z_bin]:self.offsets[base + z_bin + 1]]
+
+    def query(self, key, phi, dphi, z_min=-np.inf, z_max=np.inf):
+        """Find the hits of one layer around many query points
+
+        Returns (i, j) where j are the row positions of the hits with
+        |phi_hit - phi[i]| <= dphi (wrapped) and z_min[i] <= z_hit <= z_max[i].
+        z_min and z_max are broadcast to the shape of phi.
+        """
+        phi = np.atleast_1d(np.asarray(phi, dtype=np.float64))
+        z_min = np.broadcast_to(np.asarray(z_min, dtype=np.float64), phi.shape)
+        z_max = np.broadcast_to(np.asarray(z_max, dtype=np.float64), phi.shape)
+        layer = self.layer_number(key)
+        if layer is None or phi.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # Phi bins spanned by each window, wrapping around
+        n_phi = self.n_phi_bins
+        if dphi >= np.pi:
+            first_bin = np.zeros(phi.shape[0], dtype=np.int64)
+            n_bins = np.full(phi.shape[0], n_phi, dtype=np.int64)
+        else:
+            # widened by a rounding margin at the bin edges
+            scale = n_phi / (2*np.pi)
+            first_bin = np.floor((phi - dphi) * scale - 1e-9).astype(np.int64)
+            last_bin = np.floor((phi + dphi) * scale + 1e-9).astype(np.int64)
+            n_bins = np.minimum(last_bin - first_bin + 1, n_phi)
+
+        # One contiguous slice over the z bin range per (query, phi bin)
+        layers = np.full(phi.shape[0], layer)
+        z_first = self._z_bin(layers, z_min)
+        z_last = self._z_bin(layers, z_max)
+        query = np.repeat(np.arange(phi.shape[0]), n_bins)
+        step = np.arange(query.shape[0]) - np.repeat(np.cumsum(n_bins) - n_bins, n_bins)
+        phi_bin = np.mod(first_bin[query] + step, n_phi)
+        base = (layer * n_phi + phi_bin) * self.n_z_bins
+        lo = self.offsets[base + z_first[query]]
+        hi = self.offsets[base + z_last[query] + 1]
+        counts = np.maximum(hi - lo, 0)
+        i = np.repeat(query, counts)
+        k = np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+        # Exact selection inside the bins
+        delta = np.mod(self.phi[k] - phi[i] + np.pi, 2*np.pi) - np.pi
+        mask = ((np.abs(delta) <= dphi) &
+                (self.z[k] >= z_min[i]) & (self.z[k] <= z_max[i]))
+        return i[mask], self.hit_index[k[mask]]
@@ -4,34 +4,271 @@ PyTorch specification for the hit graph dataset.
 
 # System imports
 import os
+import math
 import logging
+import multiprocessing
+from collections import OrderedDict
 
 # External imports
 import numpy as np
 import torch
-from torch.utils.data import Dataset, random_split
+from torch.utils.data import Dataset, Sampler, Subset, random_split
 
 # Local imports
-from datasets.graph import load_graph
+from .graph import (Graph, SparseGraph, load_graph, graph_size,
+                    graph_to_sparse_graph)
+from .graph_archive import GraphArchive
+
+class GraphCache(object):
+    """Least-recently-used cache of decoded graphs bounded in bytes
+
+    The cached graphs live in the process that loaded them, so every
+    DataLoader worker fills its own cache (use persistent workers to keep it
+    over epochs). The hit/miss/eviction counters are in shared memory and
+    count over the main process and all its workers.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._graphs = OrderedDict()
+        self._counts = multiprocessing.Array('q', 3)
+
+    def __getstate__(self):
+        # Workers start with an empty cache but share the counters
+        return dict(max_bytes=self.max_bytes, counts=self._counts)
+
+    def __setstate__(self, state):
+        self.max_bytes = state['max_bytes']
+        self.nbytes = 0
+        self._graphs = OrderedDict()
+        self._counts = state['counts']
+
+    def _count(self, i):
+        with self._counts.get_lock():
+            self._counts[i] += 1
+
+    def get(self, key, load):
+        """Return the graph for key, calling load() on a miss"""
+        graph = self._graphs.pop(key, None)
+        if graph is not None:
+            self._count(0)
+            self._graphs[key] = graph
+            return graph
+        self._count(1)
+        graph = load()
+        size = sum(a.nbytes for a in graph)
+        if size <= self.max_bytes:
+            while self.nbytes + size > self.max_bytes:
+                _, evicted = self._graphs.popitem(last=False)
+                self.nbytes -= sum(a.nbytes for a in evicted)
+                self._count(2)
+            self._graphs[key] = graph
+            self.nbytes += size
+        return graph
+
+    def __len__(self):
+        return len(self._graphs)
+
+    def stats(self):
+        """Counters over all processes, entries and bytes of this process"""
+        hits, misses, evictions = self._counts[:]
+        return dict(hits=hits, misses=misses, evictions=evictions,
+                    entries=len(self._graphs), nbytes=self.nbytes)
 
 class HitGraphDataset(Dataset):
-    """PyTorch dataset specification for hit graphs"""
+    """PyTorch dataset specification for hit graphs
 
-    def __init__(self, input_dir, n_samples=None):
+    input_dir is either a directory of per-event npz files or a single-file
+    graph archive (see graph_archive.py). With cache_bytes, decoded graphs
+    are kept in a GraphCache of that size. The cached graphs are shared
+    between accesses and must not be modified. Sparse graphs read from an
+    archive are memory-mapped views and bypass the cache.
+    """
+
+    def __init__(self, input_dir, n_samples=None, graph_type=Graph,
+                 cache_bytes=None):
         input_dir = os.path.expandvars(input_dir)
-        filenames = [os.path.join(input_dir, f) for f in os.listdir(input_dir)
-                     if f.startswith('event') and f.endswith('.npz')]
-        self.filenames = (
-            filenames[:n_samples] if n_samples is not None else filenames)
+        self.graph_type = graph_type
+        self.cache = GraphCache(cache_bytes) if cache_bytes else None
+        if os.path.isfile(input_dir):
+            self.archive = GraphArchive(input_dir)
+            n_graphs = len(self.archive)
+            self.filenames = None
+            self.n_samples = (min(n_samples, n_graphs)
+                              if n_samples is not None else n_graphs)
+        else:
+            self.archive = None
+            filenames = [os.path.join(input_dir, f) for f in os.listdir(input_dir)
+                         if f.startswith('event') and f.endswith('.npz')]
+            self.filenames = (
+                filenames[:n_samples] if n_samples is not None else filenames)
+            self.n_samples = len(self.filenames)
+
+    def _load(self, index):
+        if self.archive is not None:
+            return self.archive.load_graph(index, self.graph_type)
+        return load_graph(self.filenames[index], self.graph_type)
 
     def __getitem__(self, index):
-        return load_graph(self.filenames[index])
+        # Sparse graphs of an archive are zero-copy views of the memory map,
+        # there is nothing decoded to cache
+        zero_copy = self.archive is not None and self.graph_type is SparseGraph
+        if self.cache is not None and not zero_copy:
+            return self.cache.get(index, lambda: self._load(index))
+        return self._load(index)
 
     def __len__(self):
-        return len(self.filenames)
+        return self.n_samples
+
+    def graph_sizes(self):
+        """Number of nodes and edges of every graph, without loading them"""
+        if self.archive is not None:
+            return (self.archive.n_nodes()[:self.n_samples],
+                    self.archive.n_edges()[:self.n_samples])
+        sizes = np.array([graph_size(f) for f in self.filenames],
+                         dtype=np.int64).reshape(-1, 2)
+        return sizes[:, 0], sizes[:, 1]
+
+def get_graph_sizes(dataset):
+    """Graph sizes of a HitGraphDataset or of a (nested) Subset of it"""
+    if isinstance(dataset, Subset):
+        n_nodes, n_edges = get_graph_sizes(dataset.dataset)
+        indices = np.asarray(dataset.indices, dtype=np.int64)
+        return n_nodes[indices], n_edges[indices]
+    return dataset.graph_sizes()
+
+class SizeBucketBatchSampler(Sampler):
+    """Batch sampler grouping graphs of similar size
+
+    Every epoch the (shuffled) indices are split into pools of
+    batch_size * pool_factor graphs, each pool is sorted by
+    (n_edges, n_nodes) and cut into batches, and the batch order is shuffled.
+    Batches hold batch_size graphs, or with max_tokens as many graphs as fit
+    into n_graphs * max_nodes * max_edges <= max_tokens, the number of
+    entries of each padded dense Ri/Ro batch matrix. A single graph larger
+    than max_tokens gets a batch of its own.
+
+    With distributed=True (or an explicit num_replicas/rank) every replica gets
+    its own shard of the indices, as with DistributedSampler, and set_epoch has
+    to be called at the start of each epoch. With max_tokens all replicas pack
+    the same global batch list and take every num_replicas-th batch; the list
+    is padded by repeating batches (or cut with drop_last) so that every
+    replica gets the same number of batches.
+
+    padding_ratio holds, for the last epoch, the padded share of the batch
+    area n_graphs * max_nodes * max_edges, i.e. the part outside the
+    n_nodes x n_edges blocks of the graphs.
+    """
 
-def get_datasets(input_dir, n_train, n_valid):
-    data = HitGraphDataset(input_dir, n_train + n_valid)
+    def __init__(self, n_nodes, n_edges, batch_size, max_tokens=None,
+                 pool_factor=50, shuffle=True, drop_last=False, seed=0,
+                 distributed=False, num_replicas=None, rank=None):
+        if distributed:
+            import torch.distributed as dist
+            num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+            rank = dist.get_rank() if rank is None else rank
+        self.n_nodes = np.asarray(n_nodes, dtype=np.int64)
+        self.n_edges = np.asarray(n_edges, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_factor = pool_factor
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = 1 if num_replicas is None else num_replicas
+        self.rank = 0 if rank is None else rank
+        self.epoch = 0
+        self.padding_ratio = None
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, **kwargs):
+        n_nodes, n_edges = get_graph_sizes(dataset)
+        return cls(n_nodes, n_edges, batch_size, **kwargs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _indices(self, shard=True):
+        n_graphs = self.n_nodes.shape[0]
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            indices = rng.permutation(n_graphs)
+        else:
+            indices = np.arange(n_graphs)
+        if not shard:
+            return indices
+        # Pad to a multiple of the replicas like DistributedSampler
+        total_size = int(math.ceil(n_graphs / float(self.num_replicas))) * self.num_replicas
+        indices = np.resize(indices, total_size)
+        return indices[self.rank:total_size:self.num_replicas]
+
+    def _split(self, pool):
+        if self.max_tokens is None:
+            batches = [pool[i:i + self.batch_size]
+                       for i in range(0, pool.shape[0], self.batch_size)]
+            if self.drop_last and batches and batches[-1].shape[0] < self.batch_size:
+                batches.pop()
+            return batches
+        # Greedy packing of the sorted pool under the budget on the padded
+        # Ri/Ro size n_graphs * max_nodes * max_edges
+        batches, start, max_nodes, max_edges = [], 0, 0, 0
+        for i, index in enumerate(pool):
+            nodes = max(max_nodes, self.n_nodes[index])
+            edges = max(max_edges, self.n_edges[index])
+            if i > start and (i - start + 1) * nodes * edges > self.max_tokens:
+                batches.append(pool[start:i])
+                start = i
+                nodes, edges = self.n_nodes[index], self.n_edges[index]
+            max_nodes, max_edges = nodes, edges
+        if start < pool.shape[0]:
+            batches.append(pool[start:])
+        return batches
+
+    def _batches(self):
+        # Token packing gives shards different batch counts, so pack globally
+        # and deal the batches out to the replicas instead
+        pack_globally = self.max_tokens is not None and self.num_replicas > 1
+        indices = self._indices(shard=not pack_globally)
+        pool_size = self.batch_size * self.pool_factor
+        batches = []
+        for i in range(0, indices.shape[0], pool_size):
+            pool = indices[i:i + pool_size]
+            pool = pool[np.lexsort((self.n_nodes[pool], self.n_edges[pool]))]
+            batches.extend(self._split(pool))
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if pack_globally:
+            if self.drop_last:
+                n_batches = len(batches) // self.num_replicas * self.num_replicas
+            else:
+                n_batches = (int(math.ceil(len(batches) / float(self.num_replicas))) *
+                             self.num_replicas)
+            batches = [batches[i % len(batches)] for i in range(n_batches)]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        used, padded = 0, 0
+        for batch in batches:
+            n_nodes, n_edges = self.n_nodes[batch], self.n_edges[batch]
+            used += (n_nodes * n_edges).sum()
+            padded += batch.shape[0] * n_nodes.max() * n_edges.max()
+        self.padding_ratio = 1 - float(used) / padded if padded > 0 else 0.
+        logging.info('Size bucketed batches: %i batches, padding ratio %.3f',
+                     len(batches), self.padding_ratio)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self._batches())
+
+def get_datasets(input_dir, n_train, n_valid, graph_type=Graph,
+                 cache_bytes=None):
+    data = HitGraphDataset(input_dir, n_train + n_valid, graph_type,
+                           cache_bytes=cache_bytes)
     # Split into train and validation
     train_data, valid_data = random_split(data, [n_train, n_valid])
     return train_data, valid_data
@@ -78,3 +315,42 @@ def collate_fn(graphs):
     batch_inputs = [torch.from_numpy(bm) for bm in [batch_X, batch_Ri, batch_Ro]]
     batch_target = torch.from_numpy(batch_y)
     return batch_inputs, batch_target
+
+def sparse_collate_fn(graphs):
+    """
+    Collate function for building mini-batches from a list of hit-graphs
+    as one block-diagonal graph, without any padding.
+    The node features and targets of all graphs are concatenated and the
+    edge indices are shifted by the node offset of their graph, so the batch
+    size is linear in the total number of nodes and edges.
+
+    Returns batch_inputs = [X, Ri_index, Ro_index, batch] where batch holds
+    the graph index of each node, and batch_target = y.
+    """
+    graphs = [g if isinstance(g, SparseGraph) else graph_to_sparse_graph(g)
+              for g in graphs]
+    n_nodes = np.array([g.X.shape[0] for g in graphs])
+    node_offsets = np.cumsum(n_nodes) - n_nodes
+
+    batch_X = np.concatenate([g.X for g in graphs]).astype(np.float32)
+    batch_Ri = np.concatenate([g.Ri_index.astype(np.int64) + offset
+                               for g, offset in zip(graphs, node_offsets)])
+    batch_Ro = np.concatenate([g.Ro_index.astype(np.int64) + offset
+                               for g, offset in zip(graphs, node_offsets)])
+    batch_index = np.repeat(np.arange(len(graphs)), n_nodes)
+    batch_y = np.concatenate([g.y for g in graphs]).astype(np.float32)
+
+    batch_inputs = [torch.from_numpy(m) for m in
+                    [batch_X, batch_Ri, batch_Ro, batch_index]]
+    batch_target = torch.from_numpy(batch_y)
+    return batch_inputs, batch_target
+
+# Collate functions by name and the graph type they expect from the dataset
+collate_fns = dict(dense=(collate_fn, Graph),
+                   sparse=(sparse_collate_fn, SparseGraph))
+
+def get_collate_fn(name):
+    """Return the collate function and its input graph type by name"""
+    if name not in collate_fns:
+        raise Exception('Collate function %s unknown' % name)
+    return collate_fns[name]
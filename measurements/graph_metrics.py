@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+""" graph_metrics.py: per-event graph metrics without loading the graphs
+
+    For each graph only y is read; the number of nodes comes from the npy
+    header of X and the file size from the file system, so the dense Ri/Ro
+    matrices are never built. Directories of per-event npz graphs (or single
+    graph archives, see data_structures/graph_archive.py) are scanned in a
+    process pool and the rows are streamed to the caller as they come in.
+    With a MetricsCache the rows are kept on disk keyed by the path, size and
+    mtime of each graph file, so a rerun only reads new or modified graphs.
+"""
+
+import os
+import sys
+import multiprocessing
+sys.path.append("../")
+
+import numpy as np
+
+from data_structures.graph import load_graph_shapes
+from data_structures.graph_archive import GraphArchive
+
+METRICS = ['seg_eff', 'truth_eff', 'n_nodes', 'n_edges', 'size']
+
+def graph_metrics(file_name):
+    """ metrics of one npz graph: evt_id, n_nodes, n_edges, n_true, size [MB]
+    """
+    n_nodes = load_graph_shapes(file_name)['X'][0]
+    with np.load(file_name) as f:
+        y = f['y']
+    return {'evt_id' : os.path.basename(file_name).split('_')[0],
+            'n_nodes': int(n_nodes),
+            'n_edges': int(y.shape[0]),
+            'n_true' : float(np.sum(y)),
+            'size'   : os.path.getsize(file_name)/10**6}
+
+def archive_metrics(file_name):
+    """ metrics of all graphs of a graph archive, the size is the size of the
+        arrays of each graph in the archive
+    """
+    archive = GraphArchive(file_name)
+    rows = []
+    for i in range(len(archive)):
+        # zero-copy views, only y is actually read
+        graph = archive[i]
+        name = archive.names[i] if archive.names else 'graph%06i' % i
+        rows.append({'evt_id' : name.split('_')[0],
+                     'n_nodes': int(graph.X.shape[0]),
+                     'n_edges': int(graph.y.shape[0]),
+                     'n_true' : float(np.sum(graph.y)),
+                     'size'   : sum(a.nbytes for a in graph)/10**6})
+    return rows
+
+# columns of the rows and of the cache file
+ROW_COLUMNS = ['evt_id', 'n_nodes', 'n_edges', 'n_true', 'size']
+
+class MetricsCache(object):
+    """ persistent metrics rows of graph files, valid as long as the size and
+        mtime of the file are unchanged
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.entries = {}
+        if os.path.exists(file_name):
+            with np.load(file_name) as f:
+                table = dict((k, f[k]) for k in ['path', 'stamp'] + ROW_COLUMNS)
+            for j, path in enumerate(table['path']):
+                stamp, rows = self.entries.setdefault(
+                    str(path), (tuple(table['stamp'][j].tolist()), []))
+                rows.append(dict((k, table[k][j].item()) for k in ROW_COLUMNS))
+
+    @staticmethod
+    def stamp(path):
+        st = os.stat(path)
+        return (float(st.st_size), float(st.st_mtime))
+
+    def get(self, path):
+        """ cached rows of path, None if the file is new or has changed
+        """
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != self.stamp(path):
+            return None
+        return entry[1]
+
+    def put(self, path, rows):
+        self.entries[path] = (self.stamp(path), rows)
+
+    def save(self):
+        """ write the rows of all graph files that still exist
+        """
+        table = dict((k, []) for k in ['path', 'stamp'] + ROW_COLUMNS)
+        for path, (stamp, rows) in sorted(self.entries.items()):
+            if not os.path.exists(path):
+                continue
+            for row in rows:
+                table['path'].append(path)
+                table['stamp'].append(stamp)
+                for k in ROW_COLUMNS:
+                    table[k].append(row[k])
+        tmp_file = self.file_name + '.tmp-%i.npz' % os.getpid()
+        np.savez(tmp_file, path=np.array(table['path'], dtype=str),
+                 stamp=np.array(table['stamp'], dtype=np.float64).reshape(-1, 2),
+                 evt_id=np.array(table['evt_id'], dtype=str),
+                 n_nodes=np.array(table['n_nodes'], dtype=np.int64),
+                 n_edges=np.array(table['n_edges'], dtype=np.int64),
+                 n_true=np.array(table['n_true'], dtype=np.float64),
+                 size=np.array(table['size'], dtype=np.float64))
+        os.rename(tmp_file, self.file_name)
+
+def _scan_task(args):
+    key, path = args
+    if path.endswith('.npz'):
+        return key, path, [graph_metrics(path)]
+    return key, path, archive_metrics(path)
+
+def scan_dirs(dirs, n_workers=None, cache=None):
+    """ yield (index into dirs, metrics row) for all graphs in dirs, in the
+        order they are done; entries of dirs that are files are read as graph
+        archives. Graphs found in the cache are yielded first without being
+        read, the others are read and added to the cache
+    """
+    tasks = []
+    for key, d in enumerate(dirs):
+        if os.path.isfile(d):
+            paths = [d]
+        else:
+            paths = [os.path.join(d, f) for f in sorted(os.listdir(d))
+                     if f.endswith('.npz')]
+        for path in paths:
+            rows = cache.get(path) if cache is not None else None
+            if rows is None:
+                tasks.append((key, path))
+            else:
+                for row in rows:
+                    yield key, row
+    if not tasks:
+        return
+    if n_workers == 1:
+        results = map(_scan_task, tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap_unordered(_scan_task, tasks, chunksize=8)
+    try:
+        for key, path, rows in results:
+            if cache is not None:
+                cache.put(path, rows)
+            for row in rows:
+                yield key, row
+    finally:
+        if n_workers != 1:
+            pool.terminate()
+            pool.join()
+
+class MetricsSummary(object):
+    """ running mean and standard deviation of the metrics of one directory,
+        filled row by row
+    """
+
+    def __init__(self, truth=None):
+        # truth: {evt_id: true number of segments} for the truth efficiency
+        self.truth = truth
+        self.n = dict((m, 0) for m in METRICS)
+        self.sums = dict((m, 0.) for m in METRICS)
+        self.sumsq = dict((m, 0.) for m in METRICS)
+
+    def add(self, row):
+        values = {'seg_eff': np.float64(row['n_true'])/row['n_edges'],
+                  'n_nodes': row['n_nodes'],
+                  'n_edges': row['n_edges'],
+                  'size'   : row['size']}
+        if self.truth is not None and row['evt_id'] in self.truth:
+            values['truth_eff'] = np.float64(row['n_true'])/self.truth[row['evt_id']]
+        for m, v in values.items():
+            self.n[m] += 1
+            self.sums[m] += v
+            self.sumsq[m] += v*v
+
+    def mean_std(self, metric):
+        n = self.n[metric]
+        if n == 0:
+            return [np.nan, np.nan]
+        mean = self.sums[metric]/n
+        return [mean, np.sqrt(max(self.sumsq[metric]/n - mean*mean, 0.))]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+""" generate_truth.py: count the true segments that the layer pair (LP) and
+    layer pair+ (LPP) strategies should capture, for a range of pt cuts
+
+    Each event is loaded once. The hits of each particle are counted per
+    layer with a single groupby, and all pt cuts are evaluated at once from
+    the particles sorted by pt:
+      * LP keeps one hit per particle per layer: nLayersHit-1 segments
+      * LPP connects all hits of a particle in adjacent layers, n_i*n_(i+1),
+        plus 2*(n_i-1) segments between the n_i hits inside a layer
+
+    The input can be any dataset accepted by trackml's load_dataset, a
+    directory or a zip file; events are read and parsed in --n-workers
+    processes. Writes truth_LP.txt and truth_LPP.txt (one line per event with
+    the counts per pt cut) and the typed table truth_counts.npz with the
+    columns event_id, pt_cut, LP and LPP.
+"""
+
+import os
+import sys
+import argparse
+sys.path.append("..")
+
+import numpy as np
+import pandas as pd
+
+from trackml.dataset import load_event, load_dataset
+
+PT_CUTS = [0.5, 0.6, 0.75, 1, 1.5, 2, 2.5, 3, 4, 5]
+
+# pixel barrel layers
+PIXEL_LAYERS = [(8,2), (8,4), (8,6), (8,8)]
+
+STRATEGIES = ['LP', 'LPP']
+
+def count_segments(hits, truth, particles, pixel_layers=PIXEL_LAYERS,
+                   pt_cuts=PT_CUTS):
+    """ return {'LP': counts, 'LPP': counts} with the number of true segments
+        of the event for particles with pt > pt_cut, for each pt cut
+    """
+    layers = pd.DataFrame(pixel_layers, columns=['volume_id', 'layer_id'])
+    layers['layer'] = np.arange(len(pixel_layers))
+    particles = particles[['particle_id']].assign(
+        pt=np.sqrt(particles.px**2 + particles.py**2))
+    hits = (hits[['hit_id', 'volume_id', 'layer_id']]
+            .merge(layers, on=['volume_id', 'layer_id'])
+            .merge(truth[['hit_id', 'particle_id']], on='hit_id')
+            .merge(particles, on='particle_id'))
+
+    # hits per particle (rows) and layer (columns)
+    n_in_layer = (hits.groupby(['particle_id', 'layer']).size()
+                  .unstack(fill_value=0)
+                  .reindex(columns=layers.layer, fill_value=0))
+    n = n_in_layer.values
+    pt = particles.set_index('particle_id').pt.loc[n_in_layer.index].values
+
+    segs = {'LP':  np.maximum((n > 0).sum(axis=1) - 1, 0),
+            'LPP': (2*np.maximum(n - 1, 0)).sum(axis=1) +
+                   (n[:, :-1] * n[:, 1:]).sum(axis=1)}
+
+    # sum over the particles above each cut from the pt-sorted particles
+    order = np.argsort(pt, kind='stable')
+    first_above = np.searchsorted(pt[order], pt_cuts, side='right')
+    counts = {}
+    for strategy in STRATEGIES:
+        above = np.concatenate([np.cumsum(segs[strategy][order][::-1])[::-1], [0]])
+        counts[strategy] = above[first_above].astype(np.int64)
+    return counts
+
+# read only what the counting needs
+PARTS = ['hits', 'particles', 'truth']
+COLUMNS = {'hits': ['hit_id', 'volume_id', 'layer_id'],
+           'particles': ['particle_id', 'px', 'py'],
+           'truth': ['hit_id', 'particle_id']}
+
+def count_event(prefix, pixel_layers=PIXEL_LAYERS, pt_cuts=PT_CUTS):
+    """ load one event and count its true segments
+    """
+    hits, particles, truth = load_event(prefix, parts=PARTS, columns=COLUMNS,
+                                        layers=pixel_layers, pt_min=min(pt_cuts))
+    return count_segments(hits, truth, particles, pixel_layers, pt_cuts)
+
+def count_dataset(path, pixel_layers=PIXEL_LAYERS, pt_cuts=PT_CUTS,
+                  n_workers=None, skip=None, n_events=None, verbose=False):
+    """ count the true segments of all events of a dataset directory or zip
+        file, loading the events in n_workers processes
+        return the event ids and the list of per event counts
+    """
+    event_ids, counts = [], []
+    for event_id, hits, particles, truth in load_dataset(
+            path, skip=skip, nevents=n_events, parts=PARTS, columns=COLUMNS,
+            layers=pixel_layers, pt_min=min(pt_cuts), nworkers=n_workers):
+        event_ids.append(event_id)
+        counts.append(count_segments(hits, truth, particles, pixel_layers, pt_cuts))
+        if verbose:
+            print(event_id, counts[-1]['LP'], counts[-1]['LPP'])
+    return event_ids, counts
+
+def truth_table(event_ids, pt_cuts, counts):
+    """ long table with one row per (event_id, pt_cut) from a list of per
+        event counts as returned by count_segments
+    """
+    n_events, n_cuts = len(event_ids), len(pt_cuts)
+    table = {'event_id': np.repeat(np.asarray(event_ids, dtype=np.int64), n_cuts),
+             'pt_cut':   np.tile(np.asarray(pt_cuts, dtype=np.float64), n_events)}
+    for strategy in STRATEGIES:
+        table[strategy] = np.array([c[strategy] for c in counts],
+                                   dtype=np.int64).reshape(-1)
+    return pd.DataFrame(table, columns=['event_id', 'pt_cut'] + STRATEGIES)
+
+def write_truth_txt(file_name, event_names, counts, strategy):
+    """ write one line per event with the counts per pt cut
+    """
+    with open(file_name, 'w') as outfile:
+        for name, c in zip(event_names, counts):
+            outfile.write(name + " " + " ".join(str(n) for n in c[strategy]) + "\n")
+
+def write_truth_table(file_name, table):
+    """ write the truth table as typed columns
+    """
+    np.savez(file_name, **dict((k, table[k].values) for k in table.columns))
+
+def read_truth_table(file_name):
+    with np.load(file_name) as f:
+        columns = ['event_id', 'pt_cut'] + STRATEGIES
+        return pd.DataFrame(dict((k, f[k]) for k in columns), columns=columns)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Count the true LP and LPP segments per event and pt cut')
+    parser.add_argument('data_dir', nargs='?', default="/home/sthais/data/sample",
+                        help='dataset directory or zip file')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--pt-cuts', type=float, nargs='+', default=PT_CUTS)
+    parser.add_argument('--n-workers', type=int, default=None)
+    parser.add_argument('--skip', type=int, default=None)
+    parser.add_argument('--n-events', type=int, default=None)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    event_ids, counts = count_dataset(args.data_dir, pt_cuts=args.pt_cuts,
+                                      n_workers=args.n_workers, skip=args.skip,
+                                      n_events=args.n_events, verbose=args.verbose)
+    event_names = ['event%09d' % event_id for event_id in event_ids]
+    for strategy in STRATEGIES:
+        write_truth_txt(os.path.join(args.output_dir, 'truth_' + strategy + '.txt'),
+                        event_names, counts, strategy)
+    write_truth_table(os.path.join(args.output_dir, 'truth_counts.npz'),
+                      truth_table(event_ids, args.pt_cuts, counts))
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,22 @@
 __authors__ = ['Moritz Kiehn', 'Sabrina Amrouche', 'Nimar Arora']
 
 import glob
+import gzip
+import hashlib
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path as op
 import re
+import shutil
+import tempfile
 import zipfile
 
+import numpy
 import pandas
 
+from .utils import _imap_ordered
+
 CELLS_DTYPES = dict([
     ('hit_id', 'i4'),
     ('ch0', 'i4'),
@@ -56,15 +65,139 @@ DTYPES = {
 }
 DEFAULT_PARTS = ['hits', 'cells', 'particles', 'truth']
 
-def _load_event_data(prefix, name):
+def _cache_stamp(name, state):
+    """Identify the cached content by schema and source state.
+    """
+    schema = ','.join('{}:{}'.format(*_) for _ in DTYPES[name].items())
+    return '{} {} {}'.format(name, schema, state)
+
+def _file_state(filename):
+    """Source state of a regular file given by its size and modification time.
+    """
+    st = os.stat(filename)
+    return '{:d} {!r}'.format(st.st_size, st.st_mtime)
+
+def _cache_path(cache_dir, source):
+    """Cache location for one source file.
+
+    The directory name contains a digest of the absolute source path so events
+    with identical file names from different datasets do not collide.
+    """
+    source = op.abspath(source)
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    base = op.basename(source).split('.', 1)[0]
+    return op.join(cache_dir, '{}-{}'.format(base, digest))
+
+def _read_cache(path, stamp, usecols=None):
+    """Read the cached columns or return None if the cache is stale.
+
+    Only the columns in `usecols` are read if it is given. The columns are
+    loaded into regular, writeable arrays; the cache avoids the csv parsing.
+    """
+    try:
+        with open(op.join(path, 'index'), 'r') as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+    if not lines or (lines[0] != stamp):
+        return None
+    data = pandas.DataFrame()
+    for i, column in enumerate(lines[1:]):
+        if (usecols is not None) and (column not in usecols):
+            continue
+        filename = op.join(path, '{:d}.npy'.format(i))
+        try:
+            data[column] = numpy.load(filename)
+        except ValueError:
+            # object columns, e.g. strings, are stored pickled
+            data[column] = numpy.load(filename, allow_pickle=True)
+    return data
+
+def _write_cache(path, data, stamp):
+    """Store one column per `.npy` file plus an index with the column names.
+
+    The files are written to a temporary directory first and then moved into
+    place, so concurrent readers never see a partially written cache.
+    """
+    parent = op.dirname(path)
+    if not op.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # created concurrently
+            if not op.isdir(parent):
+                raise
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        for i, column in enumerate(data.columns):
+            filename = op.join(tmp, '{:d}.npy'.format(i))
+            numpy.save(filename, data[column].values)
+        with open(op.join(tmp, 'index'), 'w') as f:
+            f.write('\n'.join([stamp] + [str(_) for _ in data.columns]))
+        if op.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+    except OSError:
+        # another process won the race; its content is equivalent
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not op.isdir(path):
+            raise
+
+# number of rows parsed at once when rows are filtered while reading
+READ_CHUNKSIZE = 1 << 16
+
+def _read_csv(source, name, usecols=None, keep=None):
+    """Read one csv file or file object with the typed schema.
+
+    Parameters
+    ----------
+    usecols : List[str], optional
+        Only parse the given columns.
+    keep : callable, optional
+        Row predicate that returns a boolean mask for a `pandas.DataFrame`.
+        The file is parsed in chunks and only the selected rows of each chunk
+        are retained.
+    """
+    dtype = DTYPES[name]
+    if keep is None:
+        return pandas.read_csv(source, header=0, index_col=False, dtype=dtype,
+                               usecols=usecols)
+    chunks = pandas.read_csv(source, header=0, index_col=False, dtype=dtype,
+                             usecols=usecols, chunksize=READ_CHUNKSIZE)
+    selected = [_[keep(_)] for _ in chunks]
+    return pandas.concat(selected, ignore_index=True)
+
+def _load_cached(read, name, key, state, cache_dir, usecols=None, keep=None):
+    """Load data via `read(usecols, keep)` or from the binary column cache.
+
+    The cached columns are reused as long as the schema and the source state
+    are unchanged; otherwise they are rebuilt from the full csv.
+    """
+    if cache_dir is None:
+        return read(usecols, keep)
+    path = _cache_path(cache_dir, key)
+    stamp = _cache_stamp(name, state)
+    data = _read_cache(path, stamp, usecols)
+    if data is None:
+        data = read(None, None)
+        _write_cache(path, data, stamp)
+        if usecols is not None:
+            data = data[[_ for _ in data.columns if _ in usecols]]
+    if keep is not None:
+        data = data[keep(data)].reset_index(drop=True)
+    return data
+
+def _load_event_data(prefix, name, cache_dir=None, usecols=None, keep=None):
     """Load per-event data for one single type, e.g. hits, or particles.
     """
     # csv files can be individually zipped with extension .csv.gz
     expr = '{!s}-{}.csv*'.format(prefix, name)
     files = glob.glob(expr)
-    dtype = DTYPES[name]
     if len(files) == 1:
-        return pandas.read_csv(files[0], header=0, index_col=False, dtype=dtype)
+        filename = files[0]
+        read = lambda usecols, keep: _read_csv(filename, name, usecols, keep)
+        return _load_cached(read, name, filename, _file_state(filename),
+                            cache_dir, usecols, keep)
     elif len(files) == 0:
         raise Exception('No file matches \'{}\''.format(expr))
     else:
@@ -90,7 +223,120 @@ def load_event_truth(prefix):
     """
     return _load_event_data(prefix, 'truth')
 
-def load_event(prefix, parts=DEFAULT_PARTS):
+def _part_columns(name, columns):
+    """Requested columns for one event part or None for all columns.
+    """
+    if columns is None:
+        return None
+    if isinstance(columns, dict):
+        return columns.get(name)
+    return [_ for _ in columns if _ in DTYPES[name]]
+
+def _with_columns(usecols, extra):
+    """Extend a column selection by columns needed internally.
+    """
+    if usecols is None:
+        return None
+    return list(usecols) + [_ for _ in extra if _ not in usecols]
+
+def _layer_key(volume_id, layer_id):
+    """Combine volume and layer id into a single integer key.
+    """
+    return (numpy.asarray(volume_id, dtype='i8') << 32) | numpy.asarray(layer_id, dtype='i8')
+
+def _hits_selector(volumes, layers):
+    """Row predicate selecting hits in the given volumes and layers.
+    """
+    if layers is not None:
+        layer_keys = numpy.unique([_layer_key(v, l) for v, l in layers])
+    def keep(hits):
+        mask = numpy.ones(len(hits), dtype=bool)
+        if volumes is not None:
+            mask &= numpy.isin(hits['volume_id'].values, list(volumes))
+        if layers is not None:
+            keys = _layer_key(hits['volume_id'].values, hits['layer_id'].values)
+            mask &= numpy.isin(keys, layer_keys)
+        return mask
+    return keep
+
+def _particles_selector(pt_min):
+    """Row predicate selecting particles with a transverse momentum above pt_min.
+    """
+    def keep(particles):
+        pt = numpy.sqrt(particles['px'].values**2 + particles['py'].values**2)
+        return pt_min < pt
+    return keep
+
+def _ids_selector(hit_ids, particle_ids):
+    """Row predicate selecting entries associated to the given hits/particles.
+    """
+    def keep(data):
+        mask = numpy.ones(len(data), dtype=bool)
+        if hit_ids is not None:
+            mask &= numpy.isin(data['hit_id'].values, hit_ids)
+        if particle_ids is not None:
+            mask &= numpy.isin(data['particle_id'].values, particle_ids)
+        return mask
+    return keep
+
+def _load_selected(load, parts, columns=None, volumes=None, layers=None,
+                   pt_min=None, mapper=map):
+    """Load event parts with column projection and row selection.
+
+    `load(name, usecols, keep)` loads a single part. Hits are selected by
+    volume and layer; cells and truth follow the hit selection. Particles are
+    selected by transverse momentum and truth follows the particle selection.
+    Parts needed only to derive a selection are loaded with the minimal set
+    of columns. Independent parts are loaded via `mapper`, e.g. the `map`
+    method of a thread pool.
+    """
+    # parts that define the selection are loaded first
+    tasks = []
+    if ((volumes is not None) or (layers is not None)) and \
+            (set(parts) & set(['hits', 'cells', 'truth'])):
+        usecols = _with_columns(_part_columns('hits', columns),
+                                ['hit_id', 'volume_id', 'layer_id'])
+        if 'hits' not in parts:
+            usecols = ['hit_id', 'volume_id', 'layer_id']
+        tasks.append(('hits', usecols, _hits_selector(volumes, layers)))
+    if (pt_min is not None) and (set(parts) & set(['particles', 'truth'])):
+        usecols = _with_columns(_part_columns('particles', columns),
+                                ['particle_id', 'px', 'py'])
+        if 'particles' not in parts:
+            usecols = ['particle_id', 'px', 'py']
+        tasks.append(('particles', usecols, _particles_selector(pt_min)))
+    loaded = dict(zip([_[0] for _ in tasks], mapper(lambda _: load(*_), tasks)))
+    hit_ids = loaded['hits']['hit_id'].values if 'hits' in loaded else None
+    particle_ids = (loaded['particles']['particle_id'].values
+                    if 'particles' in loaded else None)
+
+    tasks = []
+    for name in parts:
+        if name in loaded:
+            continue
+        usecols = _part_columns(name, columns)
+        if (name == 'cells') and (hit_ids is not None):
+            tasks.append((name, _with_columns(usecols, ['hit_id']),
+                          _ids_selector(hit_ids, None)))
+        elif (name == 'truth') and ((hit_ids is not None) or (particle_ids is not None)):
+            tasks.append((name, _with_columns(usecols, ['hit_id', 'particle_id']),
+                          _ids_selector(hit_ids, particle_ids)))
+        else:
+            tasks.append((name, usecols, None))
+    loaded.update(zip([_[0] for _ in tasks], mapper(lambda _: load(*_), tasks)))
+
+    data = []
+    for name in parts:
+        part = loaded[name]
+        usecols = _part_columns(name, columns)
+        # drop columns that were only needed for the selection
+        if usecols is not None:
+            part = part[list(usecols)]
+        data.append(part)
+    return tuple(data)
+
+def load_event(prefix, parts=DEFAULT_PARTS, cache_dir=None, columns=None,
+               volumes=None, layers=None, pt_min=None):
     """Load data for a single event with the given prefix.
 
     Parameters
@@ -99,6 +345,21 @@ def load_event(prefix, parts=DEFAULT_PARTS):
         The common prefix name for the event files, i.e. without `-hits.csv`).
     parts : List[{'hits', 'cells', 'particles', 'truth'}], optional
         Which parts of the event files to load.
+    cache_dir : str or pathlib.Path, optional
+        Directory for the binary column cache. On the first load each part is
+        converted into typed `.npy` columns; later loads read them directly
+        instead of parsing the csv. The cache is rebuilt automatically when
+        the source file changes.
+    columns : List[str] or Dict[str, List[str]], optional
+        Only load the given columns. A list applies to all parts and selects
+        the listed columns that exist in each part; a dict maps part names to
+        their column lists. Parts without entry in the dict are fully loaded.
+    volumes : List[int], optional
+        Only keep hits in the given volumes.
+    layers : List[Tuple[int, int]], optional
+        Only keep hits on the given (volume_id, layer_id) layers.
+    pt_min : float, optional
+        Only keep particles with a transverse momentum above `pt_min`.
 
     Returns
     -------
@@ -106,10 +367,21 @@ def load_event(prefix, parts=DEFAULT_PARTS):
         Contains a `pandas.DataFrame` for each element of `parts`. Each
         element has field names identical to the CSV column names with
         appropriate types.
+
+    Notes
+    -----
+    Row selections are applied while parsing, so rows that are not selected
+    are never materialized in full. Cells and truth entries are restricted to
+    the selected hits; truth entries are also restricted to the selected
+    particles when `pt_min` is given, which removes noise hits.
     """
-    return tuple(_load_event_data(prefix, name) for name in parts)
+    def load(name, usecols, keep):
+        return _load_event_data(prefix, name, cache_dir, usecols, keep)
+    return _load_selected(load, parts, columns, volumes, layers, pt_min)
 
-def load_dataset(path, skip=None, nevents=None, parts=DEFAULT_PARTS):
+def load_dataset(path, skip=None, nevents=None, parts=DEFAULT_PARTS,
+                 cache_dir=None, nworkers=None, prefetch=None, columns=None,
+                 volumes=None, layers=None, pt_min=None):
     """Provide an iterator over (all) events in a dataset.
 
     Parameters
@@ -122,6 +394,16 @@ def load_dataset(path, skip=None, nevents=None, parts=DEFAULT_PARTS):
         Only load a maximum of `nevents` events.
     parts : List[{'hits', 'cells', 'particles', 'truth'}], optional
         Which parts of each event files to load.
+    cache_dir : str or pathlib.Path, optional
+        Directory for the binary column cache, see `load_event`.
+    nworkers : int, optional
+        Read and parse events in a pool of `nworkers` processes. Events are
+        still yielded in order.
+    prefetch : int, optional
+        Maximum number of events that are loaded ahead of the consumer when
+        using `nworkers`. Defaults to twice the number of workers.
+    columns, volumes, layers, pt_min : optional
+        Column projection and row selection, see `load_event`.
 
     Yields
     ------
@@ -145,15 +427,111 @@ def load_dataset(path, skip=None, nevents=None, parts=DEFAULT_PARTS):
             prefixes = prefixes[:nevents]
         return prefixes
 
+    select = dict(columns=columns, volumes=volumes, layers=layers, pt_min=pt_min)
+
     # TODO use `yield from` once we increase the python requirement
-    if op.isdir(path):
-        for x in _iter_dataset_dir(path, list_prefixes(os.listdir(path)), parts):
+    if nworkers:
+        if op.isdir(path):
+            prefixes = list_prefixes(os.listdir(path))
+        else:
+            with zipfile.ZipFile(path, mode='r') as z:
+                prefixes = list_prefixes(z.namelist())
+        prefetch = prefetch or (2 * nworkers)
+        for x in _iter_dataset_pool(path, prefixes, parts, cache_dir, select,
+                                    nworkers, prefetch):
+            yield x
+    elif op.isdir(path):
+        for x in _iter_dataset_dir(path, list_prefixes(os.listdir(path)), parts,
+                                   cache_dir, select):
             yield x
     else:
         with zipfile.ZipFile(path, mode='r') as z:
-            for x in _iter_dataset_zip(z, list_prefixes(z.namelist()), parts):
+            for x in _iter_dataset_zip(z, list_prefixes(z.namelist()), parts,
+                                       cache_dir, select):
                 yield x
 
+class ZipEventStore(object):
+    """Random access to the events stored inside a zip archive.
+
+    The archive members are indexed once on construction, mapping each event
+    id to its `.csv` or `.csv.gz` member per part. Single events can then be
+    loaded without iterating over the archive or unpacking it.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        Path to a zip file containing event files.
+    cache_dir : str or pathlib.Path, optional
+        Directory for the binary column cache, see `load_event`.
+    nworkers : int, optional
+        Decompress and parse the parts of an event in a pool of `nworkers`
+        threads.
+    """
+
+    def __init__(self, path, cache_dir=None, nworkers=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._zipfile = zipfile.ZipFile(path, mode='r')
+        self._pool = (multiprocessing.pool.ThreadPool(nworkers)
+                      if nworkers else None)
+        self._members = {}
+        regex = re.compile(r'(.*event\d{9})-([a-zA-Z]+)\.csv(\.gz)?$')
+        for member in self._zipfile.namelist():
+            match = regex.match(member)
+            if match is None:
+                continue
+            event_id = _extract_event_id(match.group(1))
+            members = self._members.setdefault(event_id, {})
+            if match.group(2) in members:
+                raise Exception('Event {} part \'{}\' is stored more than once'
+                                .format(event_id, match.group(2)))
+            members[match.group(2)] = member
+
+    @property
+    def event_ids(self):
+        """Sorted list of all event ids in the archive."""
+        return sorted(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, event_id):
+        return event_id in self._members
+
+    def load_event(self, event_id, parts=DEFAULT_PARTS, columns=None,
+                   volumes=None, layers=None, pt_min=None):
+        """Load data for a single event with the given id.
+
+        See `load_event` for the parameters and the returned data.
+        """
+        try:
+            members = self._members[event_id]
+        except KeyError:
+            raise Exception('No event {} in \'{}\''.format(event_id, self.path))
+        def load(name, usecols, keep):
+            if name not in members:
+                raise Exception('No {} for event {} in \'{}\''
+                                .format(name, event_id, self.path))
+            return _load_zip_member(self._zipfile, members[name], name,
+                                    self.cache_dir, usecols, keep)
+        mapper = self._pool.map if self._pool is not None else map
+        return _load_selected(load, parts, columns, volumes, layers, pt_min,
+                              mapper=mapper)
+
+    def close(self):
+        """Close the archive and shut down the worker threads."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._zipfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 def _extract_event_id(prefix):
     """Extract event_id from prefix.
 
@@ -163,18 +541,98 @@ def _extract_event_id(prefix):
     groups = re.findall(regex, prefix)
     return int(groups[0])
 
-def _iter_dataset_dir(directory, prefixes, parts):
+def _iter_dataset_dir(directory, prefixes, parts, cache_dir=None, select=None):
     """Iterate over selected events files inside a directory.
     """
     for p in prefixes:
-        yield (_extract_event_id(p),) + load_event(op.join(directory, p), parts)
+        yield (_extract_event_id(p),) + load_event(op.join(directory, p), parts,
+                                                   cache_dir, **(select or {}))
 
-def _iter_dataset_zip(zipfile, prefixes, parts):
+def _zip_member(zipfile, prefix, name):
+    """Find the archive member for one event part, plain or gzip-compressed.
+    """
+    for member in ['{}-{}.csv'.format(prefix, name), '{}-{}.csv.gz'.format(prefix, name)]:
+        try:
+            zipfile.getinfo(member)
+            return member
+        except KeyError:
+            pass
+    raise Exception('No member matches \'{}-{}.csv*\''.format(prefix, name))
+
+def _load_zip_member(zipfile, member, name, cache_dir=None, usecols=None, keep=None):
+    """Load one event part stored as a member of a zip archive.
+
+    Members with a `.csv.gz` extension are decompressed on the fly. Cache
+    entries are keyed by the archive path and member name; the member size and
+    checksum identify the source state.
+    """
+    info = zipfile.getinfo(member)
+    key = op.join(str(zipfile.filename), member)
+    state = '{:d} {:d}'.format(info.file_size, info.CRC)
+    def read(usecols, keep):
+        with zipfile.open(member, mode='r') as f:
+            if member.endswith('.gz'):
+                with gzip.GzipFile(fileobj=f, mode='rb') as g:
+                    return _read_csv(g, name, usecols, keep)
+            return _read_csv(f, name, usecols, keep)
+    return _load_cached(read, name, key, state, cache_dir, usecols, keep)
+
+def _load_zip_event(zipfile, prefix, parts, cache_dir=None, select=None,
+                    mapper=map):
+    """Load a single event stored inside a zip archive.
+    """
+    def load(name, usecols, keep):
+        member = _zip_member(zipfile, prefix, name)
+        return _load_zip_member(zipfile, member, name, cache_dir, usecols, keep)
+    return _load_selected(load, parts, mapper=mapper, **(select or {}))
+
+def _iter_dataset_zip(zipfile, prefixes, parts, cache_dir=None, select=None):
     """Iterate over selected event files inside a zip archive.
     """
     for p in prefixes:
-        files = [zipfile.open('{}-{}.csv'.format(p, _), mode='r') for _ in parts]
-        dtypes = [DTYPES[_] for _ in parts]
-        data = tuple(pandas.read_csv(f, header=0, index_col=False, dtype=d)
-                                     for f, d in zip(files, dtypes))
+        data = _load_zip_event(zipfile, p, parts, cache_dir, select)
         yield (_extract_event_id(p),) + data
+
+# zip archive opened once by each pool worker, see `_open_worker_zipfile`
+_worker_zipfile = None
+
+def _open_worker_zipfile(path):
+    """Pool initializer opening a zip dataset once for all events of a worker.
+    """
+    global _worker_zipfile
+    if not op.isdir(path):
+        _worker_zipfile = (path, zipfile.ZipFile(path, mode='r'))
+
+def _load_dataset_event(args):
+    """Load a single event of a dataset directory or zip archive.
+
+    Module-level function with a single argument so it can be used as a
+    worker in a process pool.
+    """
+    path, prefix, parts, cache_dir, select = args
+    if op.isdir(path):
+        data = load_event(op.join(path, prefix), parts, cache_dir, **select)
+    elif _worker_zipfile is not None and _worker_zipfile[0] == path:
+        data = _load_zip_event(_worker_zipfile[1], prefix, parts, cache_dir,
+                               select)
+    else:
+        with zipfile.ZipFile(path, mode='r') as z:
+            data = _load_zip_event(z, prefix, parts, cache_dir, select)
+    return (_extract_event_id(prefix),) + data
+
+def _iter_dataset_pool(path, prefixes, parts, cache_dir, select, nworkers, prefetch):
+    """Iterate over selected events loaded ahead by a process pool.
+
+    At most `prefetch` events are in flight at any time. Results are yielded
+    in the order of `prefixes` and the pool is shut down when the iteration
+    ends or the generator is closed early.
+    """
+    tasks = ((path, p, parts, cache_dir, select) for p in prefixes)
+    pool = multiprocessing.Pool(nworkers, initializer=_open_worker_zipfile,
+                                initargs=(path,))
+    try:
+        for x in _imap_ordered(pool, _load_dataset_event, tasks, prefetch):
+            yield x
+    finally:
+        pool.terminate()
+        pool.join()
@@ -3,9 +3,37 @@
 __authors__ = ['Sabrina Amrouche', 'David Rousseau', 'Moritz Kiehn',
                'Ilija Vukotic']
 
+import multiprocessing
+
 import numpy
 import pandas
 
+from .dataset import load_dataset, load_event
+from .utils import _imap_ordered
+
+# columns needed to compute the score
+TRUTH_COLUMNS = ['hit_id', 'particle_id', 'weight']
+SUBMISSION_COLUMNS = ['hit_id', 'track_id']
+
+def _sequential_sum(values, starts, lengths, nunrolled=32):
+    """Sum contiguous segments of `values` strictly from left to right.
+
+    The summation order is the same as for a running sum in a Python loop, so
+    the results are bitwise identical to it. This is not guaranteed for
+    `numpy.add.reduceat` or `groupby().sum()` which may use pairwise or
+    compensated summation. The first `nunrolled` entries are added for all
+    segments at once; the rest of the few longer segments is accumulated
+    one segment at a time.
+    """
+    sums = numpy.zeros(len(starts), dtype=values.dtype)
+    for k in range(min(nunrolled, lengths.max(initial=0))):
+        selected = (k < lengths)
+        sums[selected] += values[starts[selected] + k]
+    for i in numpy.flatnonzero(nunrolled < lengths):
+        tail = values[starts[i] + nunrolled:starts[i] + lengths[i]]
+        sums[i] = numpy.add.accumulate(numpy.append(sums[i], tail))[-1]
+    return sums
+
 def _analyze_tracks(truth, submission):
     """Compute the majority particle, hit counts, and weight for each track.
 
@@ -32,6 +60,79 @@ def _analyze_tracks(truth, submission):
     event.drop('hit_id', axis=1, inplace=True)
     event.sort_values(by=['track_id', 'particle_id'], inplace=True)
 
+    track_id = event['track_id'].values
+    particle_id = event['particle_id'].values
+    # same precision as the running sum over python floats
+    weight = event['weight'].values.astype('f8')
+
+    # a new track starts whenever the track id changes. hits w/o track id
+    # are not equal to anything, i.e. each one forms a separate track
+    is_track_start = numpy.ones(len(event), dtype=bool)
+    is_track_start[1:] = (track_id[1:] != track_id[:-1])
+    # segments of consecutive hits from the same particle within a track
+    is_segment_start = is_track_start.copy()
+    is_segment_start[1:] |= (particle_id[1:] != particle_id[:-1])
+    seg_starts = numpy.flatnonzero(is_segment_start)
+    seg_nhits = numpy.diff(numpy.append(seg_starts, len(event)))
+    seg_track = numpy.cumsum(is_track_start)[seg_starts] - 1
+    track_starts = numpy.flatnonzero(is_track_start)
+    track_first_seg = numpy.flatnonzero(is_track_start[seg_starts])
+
+    # majority particle is the first particle with the most hits in a track
+    track_nhits = numpy.diff(numpy.append(track_starts, len(event)))
+    track_maj_nhits = numpy.maximum.reduceat(seg_nhits, track_first_seg)
+    candidates = numpy.flatnonzero(seg_nhits == track_maj_nhits[seg_track])
+    is_first = numpy.ones(len(candidates), dtype=bool)
+    is_first[1:] = (seg_track[candidates[1:]] != seg_track[candidates[:-1]])
+    maj_seg = candidates[is_first]
+    maj_particle_id = particle_id[seg_starts[maj_seg]]
+    maj_weight = _sequential_sum(weight, seg_starts[maj_seg], seg_nhits[maj_seg])
+    # use the same type promotion as a python float divided by total_weight
+    weight_type = type(1.0 / total_weight)
+
+    tracks = pandas.DataFrame({
+        'track_id': track_id[track_starts].astype(type(track_id[0].item())),
+        'nhits': track_nhits.astype('i8'),
+        'major_particle_id': maj_particle_id.astype('i8'),
+        'major_particle_nhits': particles_nhits.loc[maj_particle_id].values.astype('i8'),
+        'major_nhits': track_maj_nhits.astype('i8'),
+        'major_weight': (maj_weight.astype(weight_type) /
+                         weight_type(total_weight)),
+    })
+    cols = ['track_id', 'nhits',
+            'major_particle_id', 'major_particle_nhits',
+            'major_nhits', 'major_weight']
+    return tracks[cols]
+
+def _analyze_tracks_loop(truth, submission):
+    """Compute the majority particle, hit counts, and weight for each track.
+
+    Hit-by-hit reference implementation of `_analyze_tracks`. It is kept to
+    validate the vectorized version, see `_test`.
+
+    Parameters
+    ----------
+    truth : pandas.DataFrame
+        Truth information. Must have hit_id, particle_id, and weight columns.
+    submission : pandas.DataFrame
+        Proposed hit/track association. Must have hit_id and track_id columns.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Contains track_id, nhits, major_particle_id, major_particle_nhits,
+        major_nhits, and major_weight columns.
+    """
+    # true number of hits for each particle_id
+    particles_nhits = truth['particle_id'].value_counts(sort=False)
+    total_weight = truth['weight'].sum()
+    # combined event with minimal reconstructed and truth information
+    event = pandas.merge(truth[['hit_id', 'particle_id', 'weight']],
+                         submission[['hit_id', 'track_id']],
+                         on=['hit_id'], how='left', validate='one_to_one')
+    event.drop('hit_id', axis=1, inplace=True)
+    event.sort_values(by=['track_id', 'particle_id'], inplace=True)
+
     # ASSUMPTIONs: 0 <= track_id, 0 <= particle_id
 
     tracks = []
@@ -116,8 +217,139 @@ def score_event(truth, submission):
     submission : pandas.DataFrame
         Proposed hit/track association. Must have hit_id and track_id columns.
     """
-    tracks = _analyze_tracks(truth, submission)
+    return _score_tracks(_analyze_tracks(truth, submission))
+
+def _score_tracks(tracks):
+    """Compute the event score from the per-track majority information.
+    """
     purity_rec = numpy.true_divide(tracks['major_nhits'], tracks['nhits'])
     purity_maj = numpy.true_divide(tracks['major_nhits'], tracks['major_particle_nhits'])
     good_track = (0.5 < purity_rec) & (0.5 < purity_maj)
     return tracks['major_weight'][good_track].sum()
+
+def _score_event_task(args):
+    """Score a single event given by data frames or file paths.
+
+    Module-level function with a single argument so it can be used as a
+    worker in a process pool.
+    """
+    event_id, truth, submission = args
+    if not isinstance(truth, pandas.DataFrame):
+        truth, = load_event(truth, parts=['truth'], columns=TRUTH_COLUMNS)
+    if not isinstance(submission, pandas.DataFrame):
+        submission = pandas.read_csv(submission, usecols=SUBMISSION_COLUMNS)
+    return event_id, score_event(truth, submission), truth['weight'].sum()
+
+def iter_scores(events, nworkers=None, prefetch=None):
+    """Compute the event scores for a sequence of events.
+
+    Parameters
+    ----------
+    events : iterable
+        Provides (event_id, truth, submission) tuples. Truth is either a
+        `pandas.DataFrame` or the event file prefix, see
+        `trackml.dataset.load_event`. Submission is either a
+        `pandas.DataFrame` or the path to a csv file with hit_id and track_id
+        columns.
+    nworkers : int, optional
+        Score the events in a pool of `nworkers` processes.
+    prefetch : int, optional
+        Maximum number of events scheduled ahead of the consumer when using
+        `nworkers`. Defaults to twice the number of workers.
+
+    Yields
+    ------
+    event_id : int
+        The event identifier.
+    score : float
+        The event score.
+    weight : float
+        The total truth weight of the event.
+    """
+    if not nworkers:
+        for event in events:
+            yield _score_event_task(event)
+        return
+    # TODO use `yield from` once we increase the python requirement
+    pool = multiprocessing.Pool(nworkers)
+    try:
+        for x in _imap_ordered(pool, _score_event_task, events,
+                               prefetch or (2 * nworkers)):
+            yield x
+    finally:
+        pool.terminate()
+        pool.join()
+
+def score_dataset(path, submission, skip=None, nevents=None, nworkers=None,
+                  prefetch=None, cache_dir=None):
+    """Compute the scores for all events in a dataset.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        Path to a directory or a zip file containing the truth event files.
+    submission : pandas.DataFrame, str, or dict
+        Either a submission for the whole dataset, as a `pandas.DataFrame` or
+        the path to a csv file, with event_id, hit_id, and track_id columns;
+        or a mapping from event_id to a per-event submission given as
+        `pandas.DataFrame` or csv path with hit_id and track_id columns.
+    skip, nevents, cache_dir : optional
+        Event selection and caching for the truth, see
+        `trackml.dataset.load_dataset`.
+    nworkers, prefetch : int, optional
+        Read and parse the truth files in a pool of `nworkers` processes, see
+        `trackml.dataset.load_dataset`. The vectorized scoring itself runs in
+        the calling process, so the parsed truth is not sent to a second pool.
+
+    Returns
+    -------
+    scores : pandas.DataFrame
+        Contains event_id, score, and weight columns, where weight is the
+        total truth weight of the event.
+    score : float
+        Mean of the event scores weighted by the event weight. This is the
+        plain mean for unmodified truth files.
+    """
+    if not isinstance(submission, (pandas.DataFrame, dict)):
+        submission = pandas.read_csv(submission,
+                                     usecols=['event_id'] + SUBMISSION_COLUMNS)
+    if isinstance(submission, pandas.DataFrame):
+        submission = dict(list(submission.groupby('event_id')))
+    def events():
+        truths = load_dataset(path, skip=skip, nevents=nevents,
+                              parts=['truth'], cache_dir=cache_dir,
+                              nworkers=nworkers, prefetch=prefetch,
+                              columns=TRUTH_COLUMNS)
+        for event_id, truth in truths:
+            if event_id not in submission:
+                raise Exception('No submission for event {}'.format(event_id))
+            yield event_id, truth, submission[event_id]
+    scores = pandas.DataFrame.from_records(
+        list(iter_scores(events())),
+        columns=['event_id', 'score', 'weight'])
+    score = numpy.average(scores['score'], weights=scores['weight'])
+    return scores, score
+
+def _test(nhits=20000, seed=1):
+    """Check that `_analyze_tracks` reproduces the reference loop exactly.
+    """
+    from .randomize import drop_hits, random_solution, set_seed, shuffle_hits
+    set_seed(seed)
+    # particle 0 collects the noise hits, i.e. one very long segment
+    truth = pandas.DataFrame({
+        'hit_id': numpy.arange(1, nhits + 1, dtype='i4'),
+        'particle_id': numpy.random.randint(0, nhits // 8, size=nhits).astype('i8'),
+        'weight': numpy.random.random_sample(nhits).astype('f4'),
+    })
+    submissions = [
+        shuffle_hits(truth, 0.05),
+        drop_hits(truth, 0.1),
+        random_solution(truth, nhits // 10),
+        # hits missing from the submission
+        shuffle_hits(truth, 0.2).sample(frac=0.9, random_state=seed),
+    ]
+    for submission in submissions:
+        expected = _analyze_tracks_loop(truth, submission)
+        tracks = _analyze_tracks(truth, submission)
+        pandas.testing.assert_frame_equal(tracks, expected, check_exact=True)
+        assert score_event(truth, submission) == _score_tracks(expected)
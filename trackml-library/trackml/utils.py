@@ -2,6 +2,9 @@
 
 __authors__ = ['Moritz Kiehn']
 
+import collections
+import itertools
+
 import numpy as np
 
 def add_position_quantities(data, prefix=''):
@@ -44,3 +47,19 @@ def decode_particle_id(data):
     for name, mask, shift in components:
         data[name] = (pid & mask) >> shift
     return data
+
+def _imap_ordered(pool, func, iterable, nahead):
+    """Apply `func` to each item in a worker pool and yield results in order.
+
+    At most `nahead` items are in flight at any time, so a fast producer can
+    not fill up memory. The next item is submitted before a result is yielded
+    to keep the workers busy while the consumer handles it.
+    """
+    items = iter(iterable)
+    pending = collections.deque(pool.apply_async(func, (_,))
+                                for _ in itertools.islice(items, nahead))
+    while pending:
+        result = pending.popleft().get()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield result
@@ -68,6 +68,33 @@ def weight_order(args):
         raise Exception("hit index ", ihit, " is below zero")
     return ORDER_MATRIX[nhits, ihit]
 
+def weight_orders(ihit, nhits):
+    """Return the weights due to the hit order for arrays of hits.
+
+    Vectorized version of `weight_order`. Hits on tracks that are too long
+    for the order weight matrix are reported once with their total count;
+    invalid hit indices raise a single exception with the number of affected
+    hits.
+    """
+    ihit = numpy.asarray(ihit)
+    nhits = numpy.asarray(nhits)
+    weights = numpy.zeros(ihit.shape)
+    selected = (ORDER_MIN_HITS <= nhits)
+    nhits = numpy.minimum(nhits, ORDER_MAX_HITS)
+    long_track = selected & (ORDER_MAX_HITS <= ihit)
+    if long_track.any():
+        print("warning", numpy.count_nonzero(long_track), "hits of long true tracks with ihit >=",
+              ORDER_MAX_HITS, "proceeding with weight zero.")
+    selected &= ~long_track
+    too_large = selected & (nhits <= ihit)
+    if too_large.any():
+        raise Exception(numpy.count_nonzero(too_large), "hit indices are larger than the total number of hits")
+    negative = selected & (ihit < 0)
+    if negative.any():
+        raise Exception(numpy.count_nonzero(negative), "hit indices are below zero")
+    weights[selected] = ORDER_MATRIX[nhits[selected], ihit[selected]]
+    return weights
+
 def weight_pt(pt, pt_inf=0.5, pt_sup=3, w_min=0.2, w_max=1.):
     """Return the transverse momentum dependent hit weight.
     """
@@ -116,9 +143,9 @@ def weight_hits_phase1(truth, particles):
     combined['particle_nhits'] = combined['particle_nhits'].astype('i4')
     # compute hit count and order using absolute distance from particle vertex
     combined['abs_dvz'] = numpy.absolute(combined['tz'] - combined['particle_vz'])
-    combined['ihit'] = combined.groupby('particle_id')['abs_dvz'].rank().transform(lambda x: x - 1).fillna(0.0).astype('i4')
+    combined['ihit'] = (combined.groupby('particle_id')['abs_dvz'].rank() - 1).fillna(0.0).astype('i4')
     # compute order-dependent weight
-    combined['weight_order'] = combined[['ihit', 'particle_nhits']].apply(weight_order, axis=1)
+    combined['weight_order'] = weight_orders(combined['ihit'].values, combined['particle_nhits'].values)
 
     # compute combined weight normalized to 1
     w = combined['weight_pt'] * combined['weight_order']
@@ -168,9 +195,9 @@ def weight_hits_phase2(truth, particles):
 
     # compute hit count and order using absolute distance from particle vertex
     combined['abs_dvz'] = numpy.absolute(combined['tz'] - combined['particle_vz'])
-    combined['ihit'] = combined.groupby('particle_id')['abs_dvz'].rank().transform(lambda x: x - 1).fillna(0.0).astype('i4')
+    combined['ihit'] = (combined.groupby('particle_id')['abs_dvz'].rank() - 1).fillna(0.0).astype('i4')
     # compute order-dependent weight
-    combined['weight_order'] = combined[['ihit', 'particle_nhits']].apply(weight_order, axis=1)
+    combined['weight_order'] = weight_orders(combined['ihit'].values, combined['particle_nhits'].values)
 
     # compute normalized combined weight w/ extra particle selection
     weight = combined['weight_pt'] * combined['weight_order']
@@ -17,59 +17,14 @@ import numpy as np
 import pandas as pd
 import plot_functions as pf
 import segment_detector as sd 
+import track_features as tf
+from detector_geometry import load_geometry
 from trackml.dataset import load_event
 from trackml.dataset import load_dataset
 
-def forwardProgress(df):
-  """ forwardProgress(): check that track makes radial progress
-  """
-  radial_steps = df['tR'].diff().dropna()
-  positiveStep = False
-  negativeStep = False
-  for step in radial_steps:
-    if abs(step) > 10:
-      if step < 0: negativeStep = True
-      if step > 0: positiveStep = True
-      if negativeStep and positiveStep: return False
-  return True
-  
-detectors = pd.read_csv('../data/detectors.csv')
-
-# segment the pixel detector into phi bins:       N
-pixel_detectors = [sd.segment_detector(detectors, 2),
-                   sd.segment_detector(detectors, 4),
-                   sd.segment_detector(detectors, 6),
-                   sd.segment_detector(detectors, 8),
-                   sd.segment_detector(detectors, 10),
-                   sd.segment_detector(detectors, 12),
-                   sd.segment_detector(detectors, 14),
-                   sd.segment_detector(detectors, 16)]
-
-
-def inBin(coords, nBins):
-  """ inBin(): return true if the track is confined to one single phi bin
-  """
-  idx = int(nBins/2.0-1)
-  pixel_detector = pixel_detectors[idx]
-  
-  previous_bin = -1
-  i = 0
-  
-  for index, row in coords.iterrows():
-    bin = int(pixel_detector.loc[(pixel_detector['module_id'] == row.module_id) &
-                             (pixel_detector['layer_id'] ==  row.layer_id) &
-                             (pixel_detector['volume_id'] == row.volume_id)].bin)
-    if (i > 0):
-      if previous_bin != bin:
-        return False
-
-    previous_bin = bin
-    i+=1
-
-  return True 
-
-
-
+# phi bin of every pixel module for each number of phi bins N
+N_bins = [2, 4, 6, 8, 10, 12, 14, 16]
+module_bins = sd.ModuleBins(load_geometry(), N_bins)
 
 N_to_analyze = 10000     # total number of events to analyze
 N_total = 0              # number of analyzed events
@@ -78,9 +33,7 @@ N_backtracks = 0         # number of backtracks
 N_sparse = 0             # number of events with nLayersHits < 3
 make_plots = True
 
-to_hist = pd.DataFrame({'pt' : [], 'dPhi' : [], 'dEta' : [], 
-			'dR' : [], 'len' : [], 'nHits' : [],
-                        'nLayersHit' : [], 'nHitsPerLayer' : []})
+to_hist = []
 inSingleBin = np.array([0,0,0,0,0,0,0,0])
 
 # read in event files from the ../data directory
@@ -94,75 +47,34 @@ for evt_num in files:
                          
   print "Processing", evt_num
   hits, cells, particles, truth = load_event(os.path.join('../data', evt_num))
-  
-  particle_ids = truth.particle_id.unique()
-
-  # loop over unique particles in the event
-  for id in particle_ids:
-		
-    if int(id) == 0: continue
-    particle = particles[particles.particle_id == id]
-    
-    # apply a pT cut
-    #if (particle.iloc[0,:]['pt'] < 5): continue
-    
-    truth_track = truth[truth.particle_id == id]
-
-    N_total += 1
-    hit_ids = truth_track['hit_id']
-    
-    # hit coordinates are (volume, layer, module) for each hit
-    hit_coords = hits[(hits.hit_id).isin(hit_ids)][['volume_id', 'layer_id', 'module_id']]
-        
-    # separate the hit coordinates by volume, count the number of layers hit
-    vol7 = hit_coords[hit_coords.volume_id==7]
-    vol8 = hit_coords[hit_coords.volume_id==8]
-    vol9 = hit_coords[hit_coords.volume_id==9]    
-    nLayersHit = vol7['layer_id'].unique().shape[0] + vol8['layer_id'].unique().shape[0] + vol9['layer_id'].unique().shape[0]
-    
-    # skip bad events
-    skipEvent = False
-    if nLayersHit < 3:
-      N_sparse += 1
-      skipEvent = True
-    if not forwardProgress(truth_track):
-      N_backtracks += 1
-      skipEvent = True
-    if skipEvent: continue
-    
-    # count the hits
-    first_hit = truth_track.iloc[0,:]
-    last_hit = truth_track.iloc[-1,:]
-    nHits = truth_track.shape[0]
-    nHitsPerLayer = nHits/float(nLayersHit)
-    
+
+  # features of all particles of the event, in truth.particle_id.unique() order
+  features = tf.track_features(hits, particles, truth)
+  features = features.iloc[:N_to_analyze - N_total]
+  N_total += features.shape[0]
+
+  # skip bad events
+  N_sparse += np.sum(features.nLayersHit < 3)
+  N_backtracks += np.sum(~features.forwardProgress)
+  good = features[tf.good_tracks(features)]
+  N_good += good.shape[0]
+  to_hist.append(good)
+
+  # hit coordinates are (volume, layer, module) for each hit
+  hit_coords = truth[truth.particle_id.isin(good.particle_id)][['hit_id', 'particle_id']]
+  hit_coords = hit_coords.merge(hits[['hit_id', 'volume_id', 'layer_id', 'module_id']],
+                                on='hit_id')
+
   # decide if track stays in a single bin for different #s of phi bins
-    inSingleBin += np.array([inBin(hit_coords, 2), inBin(hit_coords, 4),
-                             inBin(hit_coords, 6), inBin(hit_coords, 8),
-                             inBin(hit_coords, 10), inBin(hit_coords, 12),
-                             inBin(hit_coords, 14), inBin(hit_coords, 16)])
-
-    # shape up particle phys coordinate quantities 
-    pt = particle.iloc[0,:]['pt']
-    dEta = abs(last_hit['eta'] - first_hit['eta'])
-    dPhi = min(2*np.pi-abs(last_hit['phi'] - first_hit['phi']),
-	       abs(last_hit['phi'] - first_hit['phi']))
-    dR = np.sqrt(dEta**2 + dPhi**2)
-    len  = np.sqrt((last_hit['tx'] - first_hit['tx'])**2 + 
-		   (last_hit['ty'] - first_hit['ty'])**2 + 
-		   (last_hit['tz'] - first_hit['tz'])**2)
-      
-    to_hist = to_hist.append({'pt' : pt, 'dEta' : dEta, 'dPhi': dPhi,
-			      'dR' : dR, 'len' : len,
-			      'nHits' : nHits, 'nLayersHit' : nLayersHit,
-                              'nHitsPerLayer' : nHitsPerLayer},
-                             ignore_index=True)
-    
-    N_good += 1
-    if N_total >= N_to_analyze: break
+  tracks, in_bin = module_bins.in_single_bin(hit_coords.particle_id.values,
+                                             hit_coords.volume_id.values,
+                                             hit_coords.layer_id.values,
+                                             hit_coords.module_id.values)
+  inSingleBin += in_bin.sum(axis=0)
 
   if N_total >= N_to_analyze: break
 
+to_hist = pd.concat(to_hist, ignore_index=True)
 inSingleBin = inSingleBin/float(N_good)
 
 print " --> There were", N_backtracks, "/", N_total, "backtracks!"
@@ -182,7 +94,7 @@ print " --> Good events analyzed:", N_good, "/", N_total
 #pf.plotBinnedHist(np.array(to_hist['pt']), np.array(to_hist['nLayersHit']), '$p_T$ [GeV]', 'nLayersHit', 70, title='nLayersHit vs. $p_T$ for all tracks', color='dodgerblue')
 #pf.plotBinnedHist(np.array(to_hist['pt']), np.array(to_hist['nHitsPerLayer']), '$p_T$ [GeV]', 'nHitsPerLayer', 70, title='nHitsPerLayer vs. $p_T$ for all tracks', color='blueviolet')
 #pf.plotBinnedHist(np.array(to_hist['pt']), np.array(to_hist['len']), '$p_T$ [Gev]', 'Track Length [mm]', 70, color='darkviolet', title='Track Length vs. $p_T$ for all tracks')
-pf.plotXY([2,4,6,8,10,12,14,16], inSingleBin, "Number of $\phi$ Bins", "Fraction", color='indigo', title='Fraction of Tracks in Single $\phi$ Bin')
+pf.plotXY(N_bins, inSingleBin, "Number of $\phi$ Bins", "Fraction", color='indigo', title='Fraction of Tracks in Single $\phi$ Bin')
 #pf.plotBinnedHist(np.array(to_hist['pt']), np.array(to_hist['dR']), '$p_T$ [GeV]', '$dR=\sqrt{d\eta^2+d\phi^2}$', 70, title='$dR$ vs. $p_T$ for all tracks', color='cornflowerblue')
 #pf.plotBinnedHist(np.array(to_hist['pt']), np.array(to_hist['dEta']), '$p_T$ [GeV]', '$d\eta$', 70, title='$d\eta$ vs. $p_T$ for all tracks', color='cornflowerblue')
 #pf.plotBinnedHist(np.array(to_hist['pt']), np.array(to_hist['dPhi']), '$p_T$ [GeV]', '$d\phi$', 70, title='$d\phi$ vs. $p_T$ for all tracks', color='cornflowerblue')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+""" detector_geometry.py: detectors.csv as contiguous per-module arrays """
+
+__author__  = "Gage DeZoort"
+__version__ = "1.0.0"
+__status__  = "Development"
+
+import os
+
+import numpy as np
+import pandas as pd
+
+DETECTORS_CSV = '../data/detectors.csv'
+
+# detectors.csv columns of the 3x3 rotation matrix, row by row
+ROTATION_COLUMNS = ['rot_xu', 'rot_xv', 'rot_xw',
+                    'rot_yu', 'rot_yv', 'rot_yw',
+                    'rot_zu', 'rot_zv', 'rot_zw']
+
+# arrays written by save() and read by load()
+ARRAYS = ['volume_id', 'layer_id', 'module_id', 'center', 'rotation',
+          'thickness', 'min_hu', 'max_hu', 'hv', 'pitch_u', 'pitch_v']
+
+class DetectorGeometry(object):
+    """ DetectorGeometry: one row per module, sorted by (volume, layer, module),
+                          so the dense module id of a module is its row and
+                          the modules of a layer are contiguous
+    """
+
+    def __init__(self, volume_id, layer_id, module_id, center, rotation,
+                 thickness, min_hu, max_hu, hv, pitch_u, pitch_v):
+        order = np.lexsort((module_id, layer_id, volume_id))
+        self.volume_id = np.asarray(volume_id, dtype=np.int64)[order]
+        self.layer_id = np.asarray(layer_id, dtype=np.int64)[order]
+        self.module_id = np.asarray(module_id, dtype=np.int64)[order]
+        self.center = np.asarray(center, dtype=np.float64)[order]
+        self.rotation = np.asarray(rotation, dtype=np.float64)[order]
+        self.thickness = np.asarray(thickness, dtype=np.float64)[order]
+        self.min_hu = np.asarray(min_hu, dtype=np.float64)[order]
+        self.max_hu = np.asarray(max_hu, dtype=np.float64)[order]
+        self.hv = np.asarray(hv, dtype=np.float64)[order]
+        self.pitch_u = np.asarray(pitch_u, dtype=np.float64)[order]
+        self.pitch_v = np.asarray(pitch_v, dtype=np.float64)[order]
+        self.n_modules = self.module_id.shape[0]
+
+        # cylindrical coordinates of the module centers, phi in [0, 2pi)
+        x, y = self.center[:, 0], self.center[:, 1]
+        self.r = np.sqrt(x**2 + y**2)
+        self.phi = np.mod(np.arctan2(y, x), 2*np.pi)
+        self.z = self.center[:, 2]
+
+        # corners in the local (u, v) frame as in getModuleCoords(), rotated
+        # and shifted to the global frame: (n_modules, 4, 3)
+        hu, hv = self.max_hu, self.hv
+        local = np.stack([np.stack([-hu, -hv, 0*hu], axis=1),
+                          np.stack([ hu, -hv, 0*hu], axis=1),
+                          np.stack([ hu,  hv, 0*hu], axis=1),
+                          np.stack([-hu,  hv, 0*hu], axis=1)], axis=1)
+        self.corners = (np.einsum('mij,mkj->mki', self.rotation, local) +
+                        self.center[:, None, :])
+
+        # O(1) lookup table (volume, layer, module) -> dense module id
+        shape = (self.volume_id.max() + 1, self.layer_id.max() + 1,
+                 self.module_id.max() + 1) if self.n_modules else (0, 0, 0)
+        self.lookup = np.full(shape, -1, dtype=np.int32)
+        self.lookup[self.volume_id, self.layer_id, self.module_id] = \
+            np.arange(self.n_modules)
+
+    @classmethod
+    def from_frame(cls, detectors):
+        """ from_frame(): geometry of a detectors.csv dataframe
+        """
+        return cls(detectors.volume_id.values, detectors.layer_id.values,
+                   detectors.module_id.values,
+                   detectors[['cx', 'cy', 'cz']].values,
+                   detectors[ROTATION_COLUMNS].values.reshape(-1, 3, 3),
+                   detectors.module_t.values, detectors.module_minhu.values,
+                   detectors.module_maxhu.values, detectors.module_hv.values,
+                   detectors.pitch_u.values, detectors.pitch_v.values)
+
+    @classmethod
+    def from_csv(cls, filename=DETECTORS_CSV):
+        return cls.from_frame(pd.read_csv(filename))
+
+    @classmethod
+    def load(cls, filename):
+        """ load(): geometry written by save()
+        """
+        with np.load(filename) as f:
+            return cls(*[f[name] for name in ARRAYS])
+
+    def save(self, filename):
+        """ save(): write the module arrays to a binary npz file
+        """
+        np.savez(filename, **dict((name, getattr(self, name)) for name in ARRAYS))
+
+    def frame(self):
+        """ frame(): the geometry as a dataframe with the detectors.csv columns
+        """
+        rotation = self.rotation.reshape(-1, 9)
+        columns = {'volume_id': self.volume_id, 'layer_id': self.layer_id,
+                   'module_id': self.module_id, 'cx': self.center[:, 0],
+                   'cy': self.center[:, 1], 'cz': self.center[:, 2],
+                   'module_t': self.thickness, 'module_minhu': self.min_hu,
+                   'module_maxhu': self.max_hu, 'module_hv': self.hv,
+                   'pitch_u': self.pitch_u, 'pitch_v': self.pitch_v}
+        for k, name in enumerate(ROTATION_COLUMNS):
+            columns[name] = rotation[:, k]
+        return pd.DataFrame(columns, columns=['volume_id', 'layer_id', 'module_id',
+                                              'cx', 'cy', 'cz'] + ROTATION_COLUMNS +
+                            ['module_t', 'module_minhu', 'module_maxhu',
+                             'module_hv', 'pitch_u', 'pitch_v'])
+
+    def module_index(self, volume_id, layer_id, module_id):
+        """ module_index(): dense module id of each (volume, layer, module),
+                            -1 for unknown modules
+        """
+        volume_id = np.asarray(volume_id, dtype=np.int64)
+        layer_id = np.asarray(layer_id, dtype=np.int64)
+        module_id = np.asarray(module_id, dtype=np.int64)
+        shape = self.lookup.shape
+        valid = ((volume_id >= 0) & (volume_id < shape[0]) &
+                 (layer_id >= 0) & (layer_id < shape[1]) &
+                 (module_id >= 0) & (module_id < shape[2]))
+        index = self.lookup[np.where(valid, volume_id, 0),
+                            np.where(valid, layer_id, 0),
+                            np.where(valid, module_id, 0)]
+        return np.where(valid, index, -1)
+
+    def layer_modules(self, volume_id, layer_id):
+        """ layer_modules(): dense module ids of all modules of a layer
+        """
+        lo = np.searchsorted(self.volume_id, volume_id, side='left')
+        hi = np.searchsorted(self.volume_id, volume_id, side='right')
+        first, last = lo + np.searchsorted(self.layer_id[lo:hi],
+                                           [layer_id, layer_id + 1])
+        return np.arange(first, last)
+
+_geometries = {}
+
+def load_geometry(filename=DETECTORS_CSV, cache=None):
+    """ load_geometry(): the geometry of a detectors.csv file, read once per
+                         process; with cache, a binary copy is written to that
+                         file and used as long as it is newer than the csv
+    """
+    if filename in _geometries:
+        return _geometries[filename]
+    if cache is None:
+        geometry = DetectorGeometry.from_csv(filename)
+    elif (os.path.exists(cache) and
+          os.path.getmtime(cache) >= os.path.getmtime(filename)):
+        geometry = DetectorGeometry.load(cache)
+    else:
+        geometry = DetectorGeometry.from_csv(filename)
+        geometry.save(cache)
+    _geometries[filename] = geometry
+    return geometry
@@ -20,6 +20,12 @@ import trackml
 from trackml.dataset import load_event
 from trackml.dataset import load_dataset
 
+try:
+    from .detector_geometry import load_geometry
+except (ImportError, ValueError):
+    # run as a script from visualization_scripts/
+    from detector_geometry import load_geometry
+
 
 def plotSingleHist(data, x_label, y_label, bins, weights=None, title='', color='blue'):
     """ plotSingleHist(): generic function for histogramming a data array
@@ -95,40 +101,60 @@ def plotTrack(track):
     plt.show()
     
 def getModuleCoords(v_id, l_id, m_id):
-    detectors = pd.read_csv('../data/detectors.csv')
-    coords = detectors[(detectors['volume_id'] == v_id) & (detectors['layer_id'] == l_id) 
-                       & (detectors['module_id'] == m_id)]
-    
-    c_vec = [coords.iloc[0]['cx'], coords.iloc[0]['cy'], coords.iloc[0]['cz']]
-    hu = coords.iloc[0]['module_maxhu']
-    hv = coords.iloc[0]['module_hv']
-    
-    def rotateCoords(vec):
-        rotation_matrix = np.array([[coords.iloc[0]['rot_xu'],coords.iloc[0]['rot_xv'],coords.iloc[0]['rot_xw']],
-                           [coords.iloc[0]['rot_yu'],coords.iloc[0]['rot_yv'],coords.iloc[0]['rot_yw']],
-                           [coords.iloc[0]['rot_zu'],coords.iloc[0]['rot_zv'],coords.iloc[0]['rot_zw']]])
-        return rotation_matrix.dot(vec)
-
-
-    v1 = rotateCoords(np.array([-hu,-hv,0]))
-    v2 = rotateCoords(np.array([hu,-hv,0]))
-    v3 = rotateCoords(np.array([hu,hv,0]))
-    v4 = rotateCoords(np.array([-hu,hv,0]))
-    
-    x = np.array([v1[0],v2[0],v3[0],v4[0]]) + c_vec[0]
-    y = np.array([v1[1],v2[1],v3[1],v4[1]]) + c_vec[1]
-    z = np.array([v1[2],v2[2],v3[2],v4[2]]) + c_vec[2]
-    
-    verts = [list(zip(x,y,z))]
+    """ getModuleCoords(): corner vertices of one module in the global frame
+    """
+    geometry = load_geometry()
+    index = geometry.module_index(v_id, l_id, m_id)
+    if index < 0:
+        raise Exception('Unknown module (volume %i, layer %i, module %i)' %
+                        (v_id, l_id, m_id))
+    verts = [[tuple(corner) for corner in geometry.corners[index]]]
     return verts
 
-def plotTrackOverLayers(track, hits, plotModules):
+def decimateModules(modules, track, lod_distance, lod_keep=10):
+    """ decimateModules(): level of detail, keep the modules (dense module ids)
+                           whose center is within lod_distance [mm] of a hit
+                           of the track and every lod_keep-th of the others
+    """
+    geometry = load_geometry()
+    track_xyz = np.stack([np.asarray(track['tx'], dtype=np.float64),
+                          np.asarray(track['ty'], dtype=np.float64),
+                          np.asarray(track['tz'], dtype=np.float64)], axis=1)
+    offsets = geometry.center[modules][:, None, :] - track_xyz[None, :, :]
+    near = np.sqrt((offsets**2).sum(axis=2)).min(axis=1) <= lod_distance
+    keep = near.copy()
+    keep[np.flatnonzero(~near)[::lod_keep]] = True
+    return modules[keep]
+
+def addModules(ax, modules, track=None, lod_distance=None, lod_keep=10,
+               facecolors='silver', linewidths=1, edgecolors='black'):
+    """ addModules(): draw modules (dense module ids) from the precomputed
+                      corners, one Poly3DCollection per layer; with a track
+                      and lod_distance, far modules are decimated
+    """
+    geometry = load_geometry()
+    modules = np.unique(modules)
+    if track is not None and lod_distance is not None and modules.shape[0]:
+        modules = decimateModules(modules, track, lod_distance, lod_keep)
+
+    # modules are sorted by (volume, layer, module), split at layer changes
+    volume_id, layer_id = geometry.volume_id[modules], geometry.layer_id[modules]
+    new_layer = (volume_id[1:] != volume_id[:-1]) | (layer_id[1:] != layer_id[:-1])
+    for layer_modules in np.split(modules, np.flatnonzero(new_layer) + 1):
+        if layer_modules.shape[0] == 0: continue
+        ax.add_collection3d(Poly3DCollection(geometry.corners[layer_modules],
+                                             facecolors=facecolors,
+                                             linewidths=linewidths,
+                                             edgecolors=edgecolors), zs='z')
+    return modules.shape[0]
+
+def plotTrackOverLayers(track, hits, plotModules, lod_distance=None, lod_keep=10):
     """ plotTrackOverLayers(): plot a track and the detector layers
                                it hits
     """
     
     volume_ids = [7,8,9]
-    detectors = pd.read_csv('../data/detectors.csv')
+    detectors = load_geometry().frame()
     detectors['xyz'] = detectors[['cx', 'cy', 'cz']].values.tolist()
     
     volumes = detectors.groupby('volume_id')['xyz'].apply(list).to_frame()	
@@ -159,9 +185,13 @@ def plotTrackOverLayers(track, hits, plotModules):
     ax.set_zlabel('z [mm]')
     
     if plotModules:
-        for index, row in hits.iterrows():
-            verts = getModuleCoords(row['volume_id'], row['layer_id'], row['module_id'])
-            ax.add_collection3d(Poly3DCollection(verts, facecolors='silver', linewidths=1, edgecolors='black'), zs='z')
+        modules = load_geometry().module_index(hits['volume_id'].values,
+                                               hits['layer_id'].values,
+                                               hits['module_id'].values)
+        if np.any(modules < 0):
+            raise Exception('Hits on modules missing from the detector geometry')
+        addModules(ax, modules, track=track,
+                   lod_distance=lod_distance, lod_keep=lod_keep)
     
     num_regions = volumes_layers.shape[0]
     for (i, row) in volumes_layers.iloc[:num_regions+1].iterrows():
@@ -172,9 +202,13 @@ def plotTrackOverLayers(track, hits, plotModules):
     plt.show()
         
 
-def plotWholeDetector():
+def plotWholeDetector(layer_ids=[8], track=None, lod_distance=None, lod_keep=10):
+    """ plotWholeDetector(): plot the modules of the given pixel layers, with
+                             the track if given; lod_distance decimates the
+                             modules far from the track
+    """
     volume_ids = [7,8,9]
-    detectors = pd.read_csv('../data/detectors.csv')
+    detectors = load_geometry().frame()
     detectors['xyz'] = detectors[['cx', 'cy', 'cz']].values.tolist()
 
     volumes = detectors.groupby('volume_id')['xyz'].apply(list).to_frame()
@@ -201,11 +235,15 @@ def plotWholeDetector():
     ax.set_zlabel('z [mm]')
 
     
-    #pixel_detector = detectors[detectors.volume_id.isin([7,8,9])]
-    pixel_detector = pixel_detector[pixel_detector.layer_id.isin([8])]
-    for index, row in pixel_detector.iterrows():
-        verts = getModuleCoords(row['volume_id'], row['layer_id'], row['module_id'])
-        ax.add_collection3d(Poly3DCollection(verts, facecolors='silver', linewidths=1, edgecolor='black'), zs='z')
+    if track is not None:
+        ax.plot(track['tx'], track['ty'], track['tz'], lw=0.5, c='skyblue')
+        ax.scatter3D(track['tx'], track['ty'], track['tz'],
+                     c=track['tR'], cmap='viridis', marker='h', s=30)
+
+    geometry = load_geometry()
+    modules = np.flatnonzero(np.isin(geometry.volume_id, volume_ids) &
+                             np.isin(geometry.layer_id, layer_ids))
+    addModules(ax, modules, track=track, lod_distance=lod_distance, lod_keep=lod_keep)
 
     plt.show()
 
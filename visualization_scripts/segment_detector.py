@@ -6,11 +6,15 @@ __author__  = "Gage DeZoort"
 __version__ = "1.0.0"
 __status__  = "Development"
 
+import sys
+sys.path.append("..")
 import math
 import numpy as np
 import pandas as pd
 pd.options.mode.chained_assignment = None
 
+from data_structures.hit_index import HitIndex
+
 def segment_detector(detectors, N):
   ''' segment_detector(): analyze detector segmenting, return detector with 
                           phi coordinates and phi bins '''
@@ -53,3 +57,45 @@ def segment_detector(detectors, N):
   print "    --> Total modules per phi bin:\n       ", total_modules_per_bin
   pixel_detector.reset_index(drop=True)
   return pixel_detector
+
+def segment_hits(hits, N, n_z_bins=1):
+  ''' segment_hits(): sort hits (x, y, z, volume_id, layer_id) into N phi
+                     bins with a grid index, return a copy of the hits with
+                     the 1-based phi bin as in segment_detector() and the
+                     index for fast per-layer/per-bin lookups '''
+
+  index = HitIndex(hits, n_phi_bins=N, n_z_bins=n_z_bins)
+  return hits.assign(bin=index.phi_bin + 1), index
+
+class ModuleBins(object):
+  ''' ModuleBins: phi bin of every module of a DetectorGeometry (see
+                 detector_geometry.py) for every requested number of bins N,
+                 binned as in segment_detector(); modules outside the pixel
+                 volumes get bin 0 '''
+
+  def __init__(self, geometry, Ns, volumes=[7,8,9]):
+    self.geometry = geometry
+    self.Ns = list(Ns)
+    pixel = np.isin(geometry.volume_id, volumes)
+
+    # bins[k] is the 1-based phi bin of each dense module id for Ns[k]
+    self.bins = np.array([np.where(pixel, np.digitize(geometry.phi,
+                                                      np.linspace(0, 2*np.pi, N+1)), 0)
+                          for N in self.Ns], dtype=np.int64).reshape(len(self.Ns), -1)
+
+  def in_single_bin(self, track_id, volume_id, layer_id, module_id):
+    ''' in_single_bin(): for hits given by their track id and module,
+                        return the unique track ids and a boolean array
+                        (n_tracks, len(Ns)) that is true where all hits of
+                        the track fall in one phi bin; hits outside the
+                        pixel detector count as bin 0 '''
+    tracks, track = np.unique(track_id, return_inverse=True)
+    index = self.geometry.module_index(volume_id, layer_id, module_id)
+    bins = np.where(index >= 0, self.bins[:, index], 0)
+    n_tracks = tracks.shape[0]
+    lowest = np.full((len(self.Ns), n_tracks), np.iinfo(np.int64).max)
+    highest = np.full((len(self.Ns), n_tracks), -1)
+    for k in range(len(self.Ns)):
+      np.minimum.at(lowest[k], track, bins[k])
+      np.maximum.at(highest[k], track, bins[k])
+    return tracks, (lowest == highest).T
@@ -61,12 +61,9 @@ num_processed = 0
 for f in files:
 	
 	print " -> Processing", path + "/" + f + "*"
-	hits, cells, particles, truth = load_event(os.path.join(path, f))
-	
-	# drop hits outside of the pixel detector 
-	hits = hits[(hits.volume_id < 10)]
-	hit_ids = hits.hit_id.unique()
-	truth = truth[truth.hit_id.isin(hit_ids)]
+	# drop hits (and their cells/truth) outside of the pixel detector while reading
+	hits, cells, particles, truth = load_event(os.path.join(path, f),
+	                                           volumes=[7, 8, 9])
 
 	# add particle physics coordinates 
 	truth['tR'] = np.sqrt(truth['tx']**2 + truth['ty']**2 + truth['tz']**2)
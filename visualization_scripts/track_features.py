@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+""" track_features.py: per-particle track features for a whole event """
+
+__author__  = "Gage DeZoort"
+__version__ = "1.0.0"
+__status__  = "Development"
+
+import numpy as np
+import pandas as pd
+
+PIXEL_VOLUMES = [7, 8, 9]
+
+FEATURES = ['particle_id', 'pt', 'dEta', 'dPhi', 'dR', 'len', 'nHits',
+            'nLayersHit', 'nHitsPerLayer', 'forwardProgress']
+
+def group_tracks(truth):
+  """ group_tracks(): sort the truth hits by particle (keeping the file order
+                      of the hits of each particle), drop noise hits;
+                      return the sorted hits and the start/end row of each
+                      particle, particles ordered by first appearance
+  """
+  truth = truth[truth.particle_id != 0]
+  order = np.argsort(truth.particle_id.values, kind='mergesort')
+  tracks = truth.iloc[order].reset_index(drop=True)
+  pid = tracks.particle_id.values
+  starts = np.flatnonzero(np.r_[True, pid[1:] != pid[:-1]])
+  ends = np.r_[starts[1:], pid.shape[0]]
+
+  # same particle order as truth.particle_id.unique()
+  first_seen = np.argsort(order[starts], kind='mergesort')
+  return tracks, starts[first_seen], ends[first_seen]
+
+def forward_progress(tR, starts, ends, min_step=10):
+  """ forward_progress(): true for the tracks whose radial steps larger than
+                          min_step are all outward or all inward
+  """
+  step = np.diff(tR)
+  # track of each row, the tracks are contiguous but in any order
+  by_row = np.argsort(starts)
+  rows = np.arange(tR.shape[0])
+  track = by_row[np.searchsorted(starts[by_row], rows, side='right') - 1]
+  same_track = track[1:] == track[:-1]
+  step_track = track[1:][same_track]
+  step = step[same_track]
+  n_tracks = starts.shape[0]
+  n_out = np.bincount(step_track, weights=step > min_step, minlength=n_tracks)
+  n_in = np.bincount(step_track, weights=step < -min_step, minlength=n_tracks)
+  return ~((n_out > 0) & (n_in > 0))
+
+def layers_hit(hits, truth, particle_ids, volumes=PIXEL_VOLUMES):
+  """ layers_hit(): number of distinct (volume, layer) of the given volumes
+                    hit by each particle
+  """
+  coords = truth[['hit_id', 'particle_id']].merge(
+    hits[['hit_id', 'volume_id', 'layer_id']], on='hit_id')
+  coords = coords[coords.volume_id.isin(volumes)]
+  coords = coords.drop_duplicates(['particle_id', 'volume_id', 'layer_id'])
+  n_layers = coords.groupby('particle_id').size()
+  return n_layers.reindex(particle_ids, fill_value=0).values
+
+def track_features(hits, particles, truth):
+  """ track_features(): pt, dEta, dPhi, dR, len, nHits, nLayersHit,
+                        nHitsPerLayer and the forward progress check of
+                        every particle of an event (skimmed truth with tR,
+                        eta and phi); first and last hit are in file order
+  """
+  tracks, starts, ends = group_tracks(truth)
+  particle_ids = tracks.particle_id.values[starts]
+  first = tracks.iloc[starts]
+  last = tracks.iloc[ends - 1]
+
+  if 'pt' in particles:
+    pt = particles.set_index('particle_id').pt
+  else:
+    pt = pd.Series(np.sqrt(particles.px.values**2 + particles.py.values**2),
+                   index=particles.particle_id.values)
+
+  nHits = ends - starts
+  nLayersHit = layers_hit(hits, truth, particle_ids)
+  dEta = np.abs(last.eta.values - first.eta.values)
+  dPhi = np.abs(last.phi.values - first.phi.values)
+  dPhi = np.minimum(2*np.pi - dPhi, dPhi)
+  length = np.sqrt((last.tx.values - first.tx.values)**2 +
+                   (last.ty.values - first.ty.values)**2 +
+                   (last.tz.values - first.tz.values)**2)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    nHitsPerLayer = nHits/nLayersHit.astype(np.float64)
+
+  return pd.DataFrame({'particle_id' : particle_ids,
+                       'pt' : pt.reindex(particle_ids).values,
+                       'dEta' : dEta, 'dPhi' : dPhi,
+                       'dR' : np.sqrt(dEta**2 + dPhi**2), 'len' : length,
+                       'nHits' : nHits, 'nLayersHit' : nLayersHit,
+                       'nHitsPerLayer' : nHitsPerLayer,
+                       'forwardProgress' : forward_progress(
+                         tracks.tR.values, starts, ends)},
+                      columns=FEATURES)
+
+def good_tracks(features):
+  """ good_tracks(): tracks with at least 3 layers hit and forward progress
+  """
+  return (features.nLayersHit >= 3) & features.forwardProgress